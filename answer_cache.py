@@ -0,0 +1,132 @@
+"""
+Bounded cache for RAG answers.
+
+Lookups hit either on an exact match of the normalized question or, when an
+embedding is given, on a cached question within `max_distance` cosine distance.
+Entries expire after `ttl` seconds and the least recently used entry is evicted
+once `max_size` is reached. The whole cache is dropped when the knowledge base
+version changes.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_MAX_DISTANCE = float(os.getenv("ANSWER_CACHE_MAX_DISTANCE", "0.05"))
+
+_NON_WORD = re.compile(r'[^\w\s]')
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_question(question: str) -> str:
+    """Lowercases a question and strips punctuation and repeated whitespace."""
+    return _WHITESPACE.sub(' ', _NON_WORD.sub(' ', question.lower())).strip()
+
+class AnswerCache:
+    """Thread-safe LRU/TTL cache of answers keyed by normalized question."""
+
+    def __init__(self, max_size=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, max_distance=ANSWER_CACHE_MAX_DISTANCE):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.version = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (answer, unit vector or None, stored_at)
+        self._matrix = None # stacked unit vectors for semantic lookups, rebuilt when entries change
+        self._matrix_keys = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(question):
+        return hashlib.sha256(normalize_question(question).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype='float32')
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _expire(self, now):
+        expired = [key for key, (_, _, stored_at) in self._entries.items() if now - stored_at > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _nearest(self, vector):
+        if self._matrix is None:
+            self._matrix_keys = [key for key, (_, unit, _) in self._entries.items() if unit is not None]
+            self._matrix = np.stack([self._entries[key][1] for key in self._matrix_keys]) if self._matrix_keys else None
+        if self._matrix is None:
+            return None
+        similarities = self._matrix @ vector
+        best = int(np.argmax(similarities))
+        if 1.0 - float(similarities[best]) <= self.max_distance:
+            return self._matrix_keys[best]
+        return None
+
+    def _hit(self, key, now):
+        """Returns True if `key` holds a fresh entry, dropping it if it has expired."""
+        if now - self._entries[key][2] > self.ttl:
+            del self._entries[key]
+            self._matrix = None
+            return False
+        self._entries.move_to_end(key)
+        return True
+
+    def get(self, question, embedding=None):
+        """
+        Returns (found, answer). `answer` may be None for questions that were
+        cached as unanswerable, so check `found` to tell a hit from a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            key = self._key(question)
+            if key in self._entries and self._hit(key, now):
+                self.exact_hits += 1
+                return True, self._entries[key][0]
+
+            if embedding is not None and self.max_distance > 0:
+                near_key = self._nearest(self._unit(embedding))
+                if near_key is not None and self._hit(near_key, now):
+                    self.semantic_hits += 1
+                    return True, self._entries[near_key][0]
+
+            self.misses += 1
+            return False, None
+
+    def put(self, question, answer, embedding=None):
+        """Stores an answer, evicting the least recently used entry when full."""
+        unit = self._unit(embedding) if embedding is not None else None
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            key = self._key(question)
+            self._entries[key] = (answer, unit, now)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def invalidate(self, version=None):
+        """Drops every entry, e.g. because the knowledge base changed to `version`."""
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+            self.version = version
+
+    def stats(self):
+        """Returns the hit/miss counters and the current size."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'exact_hits': self.exact_hits,
+                'semantic_hits': self.semantic_hits,
+                'misses': self.misses
+            }
@@ -1,7 +1,11 @@
+import html as html_escaping
 import os
+from datetime import date, datetime
+from urllib.parse import urlencode
 from flask import Flask, redirect, request, session, url_for
 from google_auth_oauthlib.flow import Flow
-from database import get_db_connection
+import triage
+from database import notify_account_changed, pooled_connection
 from security import encrypt_token_to_str
 
 app = Flask(__name__)
@@ -23,12 +27,9 @@ def index():
     """
     Main page that now lists connected accounts and provides a disconnect option.
     """
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT user_email FROM connected_accounts ORDER BY user_email;")
-    accounts = [row[0] for row in cur.fetchall()]
-    cur.close()
-    conn.close()
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT user_email FROM connected_accounts ORDER BY user_email;")
+        accounts = [row[0] for row in cur.fetchall()]
 
     # Build the HTML for the page
     html = """
@@ -71,6 +72,7 @@ def index():
 
     html += """
             <hr style="margin-top: 2em;">
+            <p><a href="/triage">Triage unhandled emails</a></p>
             <p>Connect a new Gmail account:</p>
             <a href="/connect-gmail"><button class="connect-button">Connect a Gmail Account</button></a>
         </div>
@@ -79,6 +81,152 @@ def index():
     """
     return html
 
+# --- Triage ---
+
+TRIAGE_STYLE = """
+        <style>
+            body { font-family: sans-serif; margin: 2em; }
+            .tabs a { margin-right: 1em; }
+            .tabs a.active { font-weight: bold; }
+            form.filters { margin: 1em 0; }
+            table { border-collapse: collapse; width: 100%; }
+            th, td { text-align: left; padding: 6px; border-bottom: 1px solid #ccc; vertical-align: top; }
+            .preview { color: #555; font-size: 0.9em; white-space: pre-wrap; }
+        </style>
+"""
+
+def _escape(value):
+    return html_escaping.escape('' if value is None else str(value))
+
+def _parse_date(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+def _triage_filters(args):
+    """Reads the filters from the query string, ignoring values that are not valid."""
+    filters = {
+        'status': args.get('status') if args.get('status') in triage.STATUSES else None,
+        'category': args.get('category') if args.get('category') in triage.CATEGORIES else None,
+        'min_importance': args.get('min_importance') if args.get('min_importance') in ('1', '2', '3', '4', '5') else None,
+        'since': _parse_date(args.get('since')),
+        'until': _parse_date(args.get('until')),
+        'q': (args.get('q') or '').strip() or None,
+        'customer': (args.get('customer') or '').strip() or None
+    }
+    return {key: value for key, value in filters.items() if value is not None}
+
+def _page_cursor(args):
+    try:
+        return datetime.fromisoformat(args['after_at']), int(args['after_id'])
+    except (KeyError, ValueError):
+        return None
+
+def _select(name, options, selected, label):
+    html = f'<select name="{name}"><option value="">{label}</option>'
+    for option in options:
+        chosen = ' selected' if option == selected else ''
+        html += f'<option value="{_escape(option)}"{chosen}>{_escape(option)}</option>'
+    return html + '</select>'
+
+def _triage_page(title, active, filter_form, table, total, next_after, filters):
+    html = f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>{_escape(title)}</title>
+        {TRIAGE_STYLE}
+    </head>
+    <body>
+        <p class="tabs">
+            <a href="/triage" class="{'active' if active == 'emails' else ''}">Unhandled emails</a>
+            <a href="/triage/refunds" class="{'active' if active == 'refunds' else ''}">Unknown order refunds</a>
+            <a href="/">Accounts</a>
+        </p>
+        <h1>{_escape(title)}</h1>
+        {filter_form}
+        <p>{total} matching</p>
+        {table}
+    """
+    query = {key: value.isoformat() if isinstance(value, date) else value for key, value in filters.items()}
+    html += f'<p><a href="?{urlencode(query)}">First page</a>'
+    if next_after:
+        query.update(after_at=next_after[0].isoformat(), after_id=next_after[1])
+        html += f' | <a href="?{urlencode(query)}">Next page</a>'
+    html += """</p>
+    </body>
+    </html>
+    """
+    return html
+
+@app.route('/triage')
+def triage_emails():
+    """Unhandled emails, newest first, with filters and keyset pagination."""
+    filters = _triage_filters(request.args)
+    rows, total, next_after = triage.unhandled_page(filters, _page_cursor(request.args))
+
+    filter_form = '<form class="filters" method="get">'
+    filter_form += _select('status', triage.STATUSES, filters.get('status'), 'Any status')
+    filter_form += _select('category', triage.CATEGORIES, filters.get('category'), 'Any category')
+    filter_form += _select('min_importance', ('1', '2', '3', '4', '5'), filters.get('min_importance'), 'Any importance')
+    filter_form += f' From <input type="date" name="since" value="{_escape(request.args.get("since"))}">'
+    filter_form += f' to <input type="date" name="until" value="{_escape(request.args.get("until"))}">'
+    if triage.TRIAGE_FULL_TEXT:
+        filter_form += f' <input type="search" name="q" placeholder="Search subject and body" value="{_escape(filters.get("q"))}">'
+    filter_form += ' <button type="submit">Filter</button></form>'
+
+    table = '<table><tr><th>Received</th><th>From</th><th>Subject</th><th>Category</th><th>Importance</th><th>Status</th></tr>'
+    for row in rows:
+        status_form = f'<form action="/triage/{row["id"]}/status" method="post" style="margin: 0;">'
+        status_form += _select('status', triage.STATUSES, row['status'], 'Status')
+        status_form += ' <button type="submit">Save</button></form>'
+        table += f"""
+        <tr>
+            <td>{_escape(row['received_at'].strftime('%Y-%m-%d %H:%M') if row['received_at'] else '')}</td>
+            <td>{_escape(row['received_from'])}</td>
+            <td>{_escape(row['subject'])}<div class="preview">{_escape(row['preview'])}</div></td>
+            <td>{_escape(row['category'])}</td>
+            <td>{_escape(row['importance'])}</td>
+            <td>{status_form}</td>
+        </tr>
+        """
+    table += '</table>'
+    return _triage_page("Unhandled Emails", 'emails', filter_form, table, total, next_after, filters)
+
+@app.route('/triage/refunds')
+def triage_refunds():
+    """Refund requests that named an order id we could not find, newest first."""
+    filters = _triage_filters(request.args)
+    rows, total, next_after = triage.refund_requests_page(filters, _page_cursor(request.args))
+
+    filter_form = '<form class="filters" method="get">'
+    filter_form += f'<input type="email" name="customer" placeholder="Customer email" value="{_escape(filters.get("customer"))}">'
+    filter_form += f' From <input type="date" name="since" value="{_escape(request.args.get("since"))}">'
+    filter_form += f' to <input type="date" name="until" value="{_escape(request.args.get("until"))}">'
+    filter_form += ' <button type="submit">Filter</button></form>'
+
+    table = '<table><tr><th>Logged</th><th>Customer</th><th>Order id given</th><th>Email</th></tr>'
+    for row in rows:
+        table += f"""
+        <tr>
+            <td>{_escape(row['logged_at'].strftime('%Y-%m-%d %H:%M') if row['logged_at'] else '')}</td>
+            <td>{_escape(row['customer_email'])}</td>
+            <td>{_escape(row['invalid_order_id_attempted'])}</td>
+            <td class="preview">{_escape(row['preview'])}</td>
+        </tr>
+        """
+    table += '</table>'
+    return _triage_page("Unknown Order Refunds", 'refunds', filter_form, table, total, next_after, filters)
+
+@app.route('/triage/<int:email_id>/status', methods=['POST'])
+def triage_set_status(email_id):
+    """Moves an unhandled email to the posted status and returns to the list."""
+    status = request.form.get('status')
+    if status in triage.STATUSES:
+        triage.set_status(email_id, status)
+    return redirect(request.referrer or url_for('triage_emails'))
+
 @app.route('/disconnect', methods=['POST'])
 def disconnect():
     """
@@ -86,12 +234,10 @@ def disconnect():
     """
     email_to_delete = request.form['email']
     if email_to_delete:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("DELETE FROM connected_accounts WHERE user_email = %s;", (email_to_delete,))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with pooled_connection() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM connected_accounts WHERE user_email = %s;", (email_to_delete,))
+            # Running listeners drop their cached client for the account straight away
+            notify_account_changed(cur, email_to_delete)
         print(f"Successfully disconnected account: {email_to_delete}")
     return redirect(url_for('index'))
 
@@ -132,23 +278,21 @@ def oauth2callback():
     user_email = user_info['email']
 
     # Save credentials to the database
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO connected_accounts (user_email, access_token, refresh_token, token_expiry)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (user_email) DO UPDATE SET
-            access_token = EXCLUDED.access_token,
-            refresh_token = EXCLUDED.refresh_token,
-            token_expiry = EXCLUDED.token_expiry;
-        """,
-        # Pass the NEW encrypted variables to the database
-        (user_email, encrypted_access_token, encrypted_refresh_token, credentials.expiry)
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO connected_accounts (user_email, access_token, refresh_token, token_expiry)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_email) DO UPDATE SET
+                access_token = EXCLUDED.access_token,
+                refresh_token = EXCLUDED.refresh_token,
+                token_expiry = EXCLUDED.token_expiry,
+                updated_at = NOW();
+            """,
+            # Pass the NEW encrypted variables to the database
+            (user_email, encrypted_access_token, encrypted_refresh_token, credentials.expiry)
+        )
+        notify_account_changed(cur, user_email)
 
     # Instead of a plain message, redirect back to the main page to see the updated list
     return redirect(url_for('index'))
@@ -0,0 +1,553 @@
+"""
+Benchmark for the email processing pipeline.
+
+Feeds a synthetic corpus of Question, Refund and Other emails (plain, multipart,
+HTML-only, quoted replies, attachments and large bodies) through the
+listener's staged pipeline (`pipeline.EmailPipeline`), with an in-process fake Gmail service and SQLite (or
+the configured Postgres) standing in for the database. Reports per-stage
+timings, p50/p95/p99 latencies and emails/sec, and writes them as JSON so runs
+can be compared between commits:
+
+    python benchmark.py --emails 200 --output bench.json
+    python benchmark.py --emails 200 --compare bench.json
+    python benchmark.py --fake-models   # pipeline overhead without model inference
+"""
+import argparse
+import base64
+import io
+import json
+import logging
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, redirect_stdout
+import dedup
+import gmail_service
+import llm_service
+import preclassifier
+import processing_service
+from pipeline import EmailPipeline
+
+STAGES = ("fetch", "clean", "dedup", "categorize", "embed", "retrieve", "qa", "db", "send", "mark_read")
+
+# --- Timing ---
+
+_samples = defaultdict(list)
+_samples_lock = threading.Lock()
+
+def _record(stage, seconds):
+    with _samples_lock:
+        _samples[stage].append(seconds)
+
+def _timed(stage, fn):
+    """Wraps `fn` so every call is recorded under `stage`."""
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _record(stage, time.perf_counter() - start)
+    return wrapper
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+def _summarize(values):
+    if not values:
+        return None
+    return {
+        'calls': len(values),
+        'total_ms': sum(values) * 1000,
+        'mean_ms': sum(values) / len(values) * 1000,
+        'p50_ms': _percentile(values, 0.50) * 1000,
+        'p95_ms': _percentile(values, 0.95) * 1000,
+        'p99_ms': _percentile(values, 0.99) * 1000
+    }
+
+# --- Synthetic corpus ---
+
+QUESTIONS = [
+    "How do I reset my password?",
+    "What is the return policy?",
+    "Where can I find my order history?",
+    "How do I track my shipment?",
+    "Can I change the delivery address after ordering?"
+]
+OTHER = [
+    "URGENT: I have a complaint about the delivery driver, this needs attention asap.",
+    "Just wanted to send some feedback, the new website looks great.",
+    "Weekly newsletter: our spring collection is here. Click to unsubscribe.",
+    "I have a suggestion for your mobile app, please add a dark mode.",
+    "Hello, is anyone there? I have an issue and need help."
+]
+FILLER = (
+    "Thanks for getting back to me so quickly. I have been a customer for years and "
+    "usually everything works fine, but this time I ran into a problem. "
+)
+
+def _encode(text):
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode()
+
+def _body_text(kind, rng, large_kb):
+    if kind == "Question":
+        text = f"Hi team,\n\n{rng.choice(QUESTIONS)}\n\nBest regards,\nAlex"
+    elif kind == "Refund":
+        order_id = rng.choice(["ORD12345", "ORD67890", "ORD99999", None])
+        text = (f"Hello,\n\nI would like a refund for order {order_id}, it arrived damaged." if order_id
+                else "Hello,\n\nI want my money back, the product does not work.")
+    else:
+        text = rng.choice(OTHER)
+
+    if rng.random() < 0.3:
+        quoted = "\n".join("> " + line for line in (FILLER * 3).split(". "))
+        text += f"\n\nOn Mon, Jan 1, 2024 at 10:00 AM Support <support@example.com> wrote:\n{quoted}"
+    if large_kb and rng.random() < 0.1:
+        history = "\n".join("> " + FILLER for _ in range(large_kb * 1024 // len(FILLER)))
+        text += f"\n\nOn Tue, Jan 2, 2024 at 9:00 AM Customer <c@example.com> wrote:\n{history}"
+    return text
+
+def _payload(text, rng):
+    """Wraps a body in one of the MIME layouts Gmail returns."""
+    html = "<html><body><p>" + text.replace("\n", "<br>") + "</p></body></html>"
+    layout = rng.choice(["plain", "alternative", "html", "attachment"])
+    if layout == "plain":
+        return {'mimeType': 'text/plain', 'body': {'size': len(text), 'data': _encode(text)}}
+    if layout == "html":
+        return {'mimeType': 'text/html', 'body': {'size': len(html), 'data': _encode(html)}}
+
+    alternative = {
+        'mimeType': 'multipart/alternative',
+        'body': {'size': 0},
+        'parts': [
+            {'mimeType': 'text/plain', 'body': {'size': len(text), 'data': _encode(text)}},
+            {'mimeType': 'text/html', 'body': {'size': len(html), 'data': _encode(html)}}
+        ]
+    }
+    if layout == "alternative":
+        return alternative
+    return {
+        'mimeType': 'multipart/mixed',
+        'body': {'size': 0},
+        'parts': [
+            alternative,
+            {'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'body': {'size': 250000, 'attachmentId': 'att-1'}}
+        ]
+    }
+
+def build_corpus(count, seed=42, large_kb=512):
+    """Returns `count` Gmail message resources with a deterministic mix of categories and layouts."""
+    rng = random.Random(seed)
+    messages = []
+    for i in range(count):
+        kind = rng.choice(["Question", "Refund", "Other"])
+        text = _body_text(kind, rng, large_kb)
+        payload = _payload(text, rng)
+        headers = [
+            {'name': 'From', 'value': f"Customer {i} <customer{i}@example.com>"},
+            {'name': 'To', 'value': "support@example.com"},
+            {'name': 'Subject', 'value': f"{kind} #{i}"}
+        ]
+        if rng.random() < 0.2:
+            headers.append({'name': 'In-Reply-To', 'value': f"<previous-{i}@example.com>"})
+        if "unsubscribe" in text:
+            headers.append({'name': 'List-Unsubscribe', 'value': "<mailto:unsubscribe@example.com>"})
+        payload['headers'] = headers
+        messages.append({
+            'id': f"msg-{i:06d}",
+            'threadId': f"thread-{i:06d}",
+            'labelIds': ['INBOX', 'UNREAD'],
+            'snippet': text[:100],
+            'sizeEstimate': len(text),
+            'payload': payload,
+            'expected_category': kind
+        })
+    return messages
+
+# --- Fake Gmail service ---
+
+class _Request:
+    def __init__(self, fn, latency):
+        self._fn = fn
+        self._latency = latency
+
+    def execute(self, http=None):
+        if self._latency:
+            time.sleep(self._latency)
+        return self._fn()
+
+class _Batch:
+    def __init__(self, callback, latency):
+        self._callback = callback
+        self._latency = latency
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request_id, request))
+
+    def execute(self, http=None):
+        # One round trip for the whole batch
+        if self._latency:
+            time.sleep(self._latency)
+        for request_id, request in self._requests:
+            try:
+                self._callback(request_id, request._fn(), None)
+            except Exception as error:
+                self._callback(request_id, None, error)
+
+class FakeGmailService:
+    """
+    In-process stand-in for a `googleapiclient` Gmail service.
+
+    Supports the calls the pipeline makes; `latency` seconds are slept per HTTP
+    round trip to simulate the network.
+    """
+
+    def __init__(self, messages, latency=0.0):
+        self.store = {message['id']: message for message in messages}
+        self.latency = latency
+        self.sent = []
+        self.history_id = 1000
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def _request(self, fn):
+        return _Request(fn, self.latency)
+
+    def list(self, userId, q=None, pageToken=None, startHistoryId=None, **kwargs):
+        if startHistoryId is not None:
+            return self._request(lambda: {'history': [], 'historyId': str(self.history_id)})
+        unread = [
+            {'id': m['id'], 'threadId': m['threadId']}
+            for m in self.store.values() if 'UNREAD' in m['labelIds']
+        ]
+        return self._request(lambda: {'messages': unread})
+
+    def get(self, userId, id, format='full', metadataHeaders=None, **kwargs):
+        def fetch():
+            message = self.store[id]
+            if format != 'metadata':
+                return message
+            wanted = {name.lower() for name in metadataHeaders or []}
+            headers = [h for h in message['payload']['headers'] if not wanted or h['name'].lower() in wanted]
+            metadata = {key: value for key, value in message.items() if key != 'payload'}
+            metadata['payload'] = {'mimeType': message['payload'].get('mimeType'), 'headers': headers}
+            return metadata
+        return self._request(fetch)
+
+    def modify(self, userId, id, body):
+        def apply():
+            message = self.store[id]
+            message['labelIds'] = [l for l in message['labelIds'] if l not in body.get('removeLabelIds', [])]
+            return {'id': id}
+        return self._request(apply)
+
+    def batchModify(self, userId, body):
+        def apply():
+            for message_id in body['ids']:
+                message = self.store[message_id]
+                message['labelIds'] = [l for l in message['labelIds'] if l not in body.get('removeLabelIds', [])]
+            return {}
+        return self._request(apply)
+
+    def send(self, userId, body):
+        def apply():
+            self.sent.append(body)
+            return {'id': f"sent-{len(self.sent)}"}
+        return self._request(apply)
+
+    def getProfile(self, userId):
+        return self._request(lambda: {'historyId': str(self.history_id)})
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(callback, self.latency)
+
+# --- Database stand-in ---
+
+SQLITE_SCHEMA = """
+CREATE TABLE orders (
+    order_id TEXT PRIMARY KEY, customer_email TEXT NOT NULL, order_date TEXT NOT NULL,
+    amount NUMERIC NOT NULL, status TEXT DEFAULT 'completed'
+);
+CREATE TABLE unhandled_emails (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, received_from TEXT NOT NULL, subject TEXT, body TEXT,
+    category TEXT, importance INTEGER, received_at TEXT DEFAULT CURRENT_TIMESTAMP, status TEXT DEFAULT 'pending'
+);
+CREATE TABLE not_found_refund_requests (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, customer_email TEXT NOT NULL, invalid_order_id_attempted TEXT,
+    full_email_body TEXT, logged_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+INSERT INTO orders VALUES ('ORD12345', 'sender-email@example.com', '2023-10-01', 99.99, 'completed');
+INSERT INTO orders VALUES ('ORD67890', 'another-sender@example.com', '2023-10-15', 45.50, 'completed');
+"""
+
+class _TimedCursor:
+    """Cursor proxy that records every statement under the 'db' stage."""
+
+    def __init__(self, cursor, sqlite):
+        self._cursor = cursor
+        self._sqlite = sqlite
+
+    def execute(self, query, params=None):
+        if self._sqlite:
+            query = query.replace('%s', '?')
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params or ())
+        finally:
+            _record("db", time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._cursor.close()
+
+class _TimedConnection:
+    def __init__(self, conn, sqlite):
+        self._conn = conn
+        self._sqlite = sqlite
+
+    def cursor(self, *args, **kwargs):
+        return _TimedCursor(self._conn.cursor(*args, **kwargs), self._sqlite)
+
+    def commit(self):
+        start = time.perf_counter()
+        self._conn.commit()
+        _record("db", time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+def _sqlite_insert_rows(cur, table, columns, rows):
+    # Stands in for psycopg2's execute_values, which needs a Postgres cursor
+    placeholders = ', '.join('?' for _ in columns)
+    start = time.perf_counter()
+    cur.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+    _record("db", time.perf_counter() - start)
+
+def _sqlite_connection_factory():
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    conn.executescript(SQLITE_SCHEMA)
+    lock = threading.Lock()
+
+    @contextmanager
+    def connection():
+        with lock:
+            try:
+                yield _TimedConnection(conn, sqlite=True)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    return connection
+
+def _postgres_connection_factory():
+    import database
+
+    @contextmanager
+    def connection():
+        with database.pooled_connection() as conn:
+            yield _TimedConnection(conn, sqlite=False)
+    return connection
+
+# --- Fake models ---
+
+def _fake_categorize_emails(bodies, batch_size=None):
+    categories = []
+    for body in bodies:
+        lower = body.lower()
+        categories.append("Refund" if "refund" in lower else "Question" if "?" in body else "Other")
+    return categories
+
+def _fake_embed_texts(texts):
+    # Deterministic 8-dimensional bag-of-characters vectors, enough for cache lookups
+    return [[float(sum(ord(c) for c in text[i::8]) % 97) + 1.0 for i in range(8)] for text in texts]
+
+def _fake_rag_answer(question, embedding=None):
+    return "Please see our help center." if "password" in question.lower() else None
+
+# --- Runner ---
+
+def _instrument(fake_models, db, db_kind, preclassifier_mode, dedup_enabled):
+    """Patches the pipeline's stage functions with timing wrappers."""
+    preclassifier.PRECLASSIFIER = preclassifier_mode
+    dedup.DEDUP_ENABLED = dedup_enabled
+    dedup.find_duplicates = _timed("dedup", dedup.find_duplicates)
+    # Synthetic emails must not end up in the training log
+    preclassifier.PRECLASSIFIER_LOG = None
+    for name in ("get_email_details", "get_email_details_batch"):
+        setattr(gmail_service, name, _timed("fetch", getattr(gmail_service, name)))
+    gmail_service.clean_email_body = _timed("clean", gmail_service.clean_email_body)
+    gmail_service.send_reply = _timed("send", gmail_service.send_reply)
+    gmail_service.mark_as_read = _timed("mark_read", gmail_service.mark_as_read)
+    gmail_service.mark_as_read_batch = _timed("mark_read", gmail_service.mark_as_read_batch)
+    processing_service.pooled_connection = db
+    processing_service.writes.connection_factory = db
+    if db_kind == "sqlite":
+        processing_service.writes.insert_rows = _sqlite_insert_rows
+        # The fingerprint queries are Postgres-only
+        dedup.DEDUP_PERSIST = False
+    else:
+        dedup.pooled_connection = db
+
+    if fake_models:
+        llm_service.categorize_emails = _timed("categorize", _fake_categorize_emails)
+        llm_service.categorize_email = _timed("categorize", lambda body: _fake_categorize_emails([body])[0])
+        llm_service.get_rag_answer = _timed("qa", _fake_rag_answer)
+        llm_service.embed_texts = _timed("embed", _fake_embed_texts)
+    else:
+        llm_service.categorize_emails = _timed("categorize", llm_service.categorize_emails)
+        llm_service.categorize_email = _timed("categorize", llm_service.categorize_email)
+        llm_service.embed_texts = _timed("embed", llm_service.embed_texts)
+        llm_service._embed_query = _timed("embed", llm_service._embed_query)
+        llm_service._retrieve = _timed("retrieve", llm_service._retrieve)
+        llm_service._extract_answers = _timed("qa", llm_service._extract_answers)
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _run_cycles(service, summaries, cycle_size, handlers, latencies):
+    """
+    Feeds poll cycles of `cycle_size` emails through an `EmailPipeline`, one
+    cycle at a time; every email's latency runs from the start of its cycle.
+    """
+    cycle_done = threading.Event()
+
+    def poll(account):
+        emails = processing_service.prepare_emails(service, account['summaries'])
+        return [(service, account['user_email'], email) for email in emails], None
+
+    def account_done(account, emails, error):
+        latencies.extend([time.perf_counter() - account['started']] * emails)
+        cycle_done.set()
+
+    pipeline = EmailPipeline(
+        poll_account=poll,
+        save_history_id=lambda account, history_id, failed: None,
+        fetchers=1,
+        handlers=handlers,
+        account_done=account_done
+    )
+    pipeline.start()
+    for offset in range(0, len(summaries), cycle_size):
+        cycle_done.clear()
+        pipeline.submit_account({
+            'user_email': 'bench@example.com',
+            'summaries': summaries[offset:offset + cycle_size],
+            'started': time.perf_counter()
+        })
+        cycle_done.wait()
+    pipeline.shutdown()
+
+def run(args):
+    corpus = build_corpus(args.emails, seed=args.seed, large_kb=args.large_kb)
+    service = FakeGmailService(corpus, latency=args.gmail_latency_ms / 1000)
+    db = _postgres_connection_factory() if args.db == "postgres" else _sqlite_connection_factory()
+
+    if not args.fake_models:
+        print("Loading and warming up models (not timed)...", file=sys.stderr)
+        llm_service.warm_up()
+    _instrument(args.fake_models, db, args.db, args.preclassifier, args.dedup == "on")
+
+    print(f"Processing {len(corpus)} emails in {args.mode} mode...", file=sys.stderr)
+    latencies = []
+    start = time.perf_counter()
+    if args.mode == "single":
+        for summary in gmail_service.fetch_unread_emails(service):
+            email_start = time.perf_counter()
+            processing_service.process_email(service, {'user_email': 'bench@example.com'}, summary)
+            latencies.append(time.perf_counter() - email_start)
+    else:
+        summaries = gmail_service.fetch_unread_emails(service)
+        _run_cycles(service, summaries, args.cycle_size, args.handlers, latencies)
+    elapsed = time.perf_counter() - start
+
+    return {
+        'commit': _git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'emails': len(corpus),
+        'elapsed_s': elapsed,
+        'emails_per_sec': len(corpus) / elapsed if elapsed else None,
+        'latency': _summarize(latencies),
+        'stages': {stage: _summarize(_samples[stage]) for stage in STAGES if _samples[stage]},
+        'replies_sent': len(service.sent)
+    }
+
+def _print_report(report, baseline=None):
+    def delta(new, old):
+        if old in (None, 0) or new is None:
+            return ""
+        return f" ({(new - old) / old:+.1%})"
+
+    old = baseline or {}
+    print(f"\nThroughput: {report['emails_per_sec']:.2f} emails/sec"
+          f"{delta(report['emails_per_sec'], old.get('emails_per_sec'))}")
+    latency = report['latency']
+    old_latency = old.get('latency') or {}
+    print("Latency per email: " + ", ".join(
+        f"{key[:-3]} {latency[key]:.1f}ms{delta(latency[key], old_latency.get(key))}"
+        for key in ('p50_ms', 'p95_ms', 'p99_ms')
+    ))
+    print(f"\n{'stage':<12}{'calls':>8}{'total ms':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, stats in report['stages'].items():
+        old_stats = (old.get('stages') or {}).get(stage) or {}
+        print(f"{stage:<12}{stats['calls']:>8}{stats['total_ms']:>12.1f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{delta(stats['total_ms'], old_stats.get('total_ms'))}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the email processing pipeline.")
+    parser.add_argument('--emails', type=int, default=200, help="number of synthetic emails")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--large-kb', type=int, default=512, help="size of the occasional large quoted thread")
+    parser.add_argument('--mode', choices=["batch", "single"], default="batch",
+                        help="the listener's pipeline per poll cycle, or process_email per message")
+    parser.add_argument('--cycle-size', type=int, default=50, help="emails per poll cycle in batch mode")
+    parser.add_argument('--handlers', type=int, default=4, help="pipeline handler threads in batch mode")
+    parser.add_argument('--gmail-latency-ms', type=float, default=0.0, help="simulated Gmail round-trip time")
+    parser.add_argument('--db', choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument('--fake-models', action='store_true', help="replace model inference with keyword stubs")
+    parser.add_argument('--preclassifier', choices=["off", "rules", "model"], default=preclassifier.PRECLASSIFIER,
+                        help="pre-classifier tier in front of BART")
+    parser.add_argument('--dedup', choices=["on", "off"], default="on" if dedup.DEDUP_ENABLED else "off",
+                        help="drop duplicates and same-thread follow-ups before inference")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to show deltas against")
+    parser.add_argument('--verbose', action='store_true', help="show the pipeline's own log output")
+    args = parser.parse_args()
+
+    if args.verbose:
+        report = run(args)
+    else:
+        logging.disable(logging.WARNING)
+        with redirect_stdout(io.StringIO()):
+            report = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+    _print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,121 @@
+"""
+Micro-benchmark for body extraction and cleaning on large email threads.
+
+Builds long reply chains (plain text quoted with '>', HTML with nested
+blockquotes, and unquoted Outlook-style history) and times the previous
+three-pass regex cleaner against `email_body`:
+
+    python clean_benchmark.py --sizes 1 4 --repeat 3 [--output clean.json]
+
+Only the standard library and `email_body` are imported, so it runs without
+the models or Gmail client installed.
+"""
+import argparse
+import base64
+import json
+import re
+import statistics
+import time
+import email_body
+
+REPLY = "Thanks, that helps. Could you also check whether order ORD12345 has shipped yet?"
+FILLER = "I have been a customer for years and usually everything works fine, but this time I ran into a problem."
+
+def _plain_thread(size):
+    history = []
+    depth = 1
+    while sum(len(line) for line in history) < size:
+        history.append(f"On Mon, Jan {depth % 28 + 1}, 2024 at 10:00 AM Customer <c{depth}@example.com> wrote:")
+        history.extend(">" * depth + " " + FILLER for _ in range(20))
+        depth = depth % 10 + 1
+    return REPLY + "\n\n" + "\n".join(history) + "\n-- \nAlex"
+
+def _html_thread(size):
+    chunk = f"<div class=\"gmail_quote\">On Mon, Jan 1, 2024 Customer wrote:<br><blockquote>{('<p>' + FILLER + '</p>') * 20}"
+    count = max(1, size // len(chunk))
+    return f"<html><body><div>{REPLY}</div>" + chunk * count + "</blockquote></div>" * count + "</body></html>"
+
+def _outlook_thread(size):
+    # Sentences starting with "On" but no "wrote:" make the old `On.*wrote:` rescan the rest of the body
+    block = ("\n-----Original Message-----\nFrom: Support\nSent: Monday\n\n"
+             "On Monday the parcel had still not arrived.\n" + "\n".join([FILLER] * 20))
+    return REPLY + block * max(1, size // len(block))
+
+def _payload(text, mime_type):
+    data = base64.urlsafe_b64encode(text.encode('utf-8')).decode()
+    part = {'mimeType': mime_type, 'body': {'size': len(text), 'data': data}}
+    return {'mimeType': 'multipart/mixed', 'parts': [{'mimeType': 'multipart/alternative', 'parts': [part]}]}
+
+def _legacy_find_body(parts):
+    body = ''
+    for part in parts:
+        if part.get('body') and part['body'].get('data'):
+            if part['mimeType'] == 'text/plain':
+                return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+            elif part['mimeType'] == 'text/html':
+                body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+        if 'parts' in part:
+            sub_body = _legacy_find_body(part['parts'])
+            if sub_body:
+                return sub_body
+    return body
+
+def _legacy_clean(raw_body):
+    body = re.sub(r'<[^>]+>', '', raw_body)
+    body = re.sub(r'On.*wrote:', '', body, flags=re.DOTALL)
+    body = '\n'.join([line for line in body.split('\n') if not line.strip().startswith('>')])
+    return body.strip()
+
+def _legacy(payload):
+    return _legacy_clean(_legacy_find_body(payload['parts']))
+
+def _current(payload):
+    text, mime_type = email_body.extract_body(payload)
+    return email_body.clean_body(text, mime_type == 'text/html')
+
+def _time(fn, payload, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(payload)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+def run(sizes, repeat):
+    results = []
+    for megabytes in sizes:
+        size = int(megabytes * 1024 * 1024)
+        for layout, text, mime_type in (
+            ("plain", _plain_thread(size), 'text/plain'),
+            ("html", _html_thread(size), 'text/html'),
+            ("outlook", _outlook_thread(size), 'text/plain')
+        ):
+            payload = _payload(text, mime_type)
+            legacy_seconds, legacy_cleaned = _time(_legacy, payload, repeat)
+            current_seconds, cleaned = _time(_current, payload, repeat)
+            results.append({
+                'layout': layout,
+                'megabytes': len(text) / (1024 * 1024),
+                'legacy_ms': legacy_seconds * 1000,
+                'current_ms': current_seconds * 1000,
+                'speedup': legacy_seconds / current_seconds if current_seconds else None,
+                'legacy_chars': len(legacy_cleaned),
+                'cleaned_chars': len(cleaned)
+            })
+            row = results[-1]
+            print(f"{layout:<8}{row['megabytes']:>8.1f} MB{row['legacy_ms']:>12.1f} ms{row['current_ms']:>12.1f} ms"
+                  f"{row['speedup']:>9.1f}x{row['legacy_chars']:>12}{row['cleaned_chars']:>10}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark email body extraction and cleaning.")
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1, 4], help="thread sizes in MB")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    print(f"{'layout':<8}{'size':>11}{'legacy':>15}{'current':>15}{'speedup':>10}{'kept chars: legacy':>22}{'current':>10}")
+    results = run(args.sizes, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -1,5 +1,8 @@
 import psycopg2
+import psycopg2.pool
 import os
+import threading
+from contextlib import contextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,21 +13,72 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
+# Connections kept open per process; callers beyond DB_POOL_MAX wait for a free one
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
 
-def get_db_connection():
+# Notified with the user email whenever a connected_accounts row changes or is deleted
+ACCOUNTS_CHANNEL = 'connected_accounts_changed'
+
+_pool = None
+_pool_lock = threading.Lock()
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def _connection_settings():
     # Check if all variables are set
     if not all([DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT]):
         raise ValueError("One or more database environment variables are not set.")
-    
-    conn = psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT
-    )
+    return {
+        'dbname': DB_NAME,
+        'user': DB_USER,
+        'password': DB_PASSWORD,
+        'host': DB_HOST,
+        'port': DB_PORT
+    }
+
+def get_db_connection():
+    """Opens a new, unpooled connection. Prefer `pooled_connection` for regular work."""
+    conn = psycopg2.connect(**_connection_settings())
     return conn
 
+def get_db_pool():
+    """Returns the process-wide thread-safe connection pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = psycopg2.pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **_connection_settings())
+    return _pool
+
+@contextmanager
+def pooled_connection():
+    """
+    Checks a connection out of the pool for the duration of a `with` block.
+
+    The transaction is committed when the block finishes and rolled back if it
+    raises. The connection is then returned to the pool, or discarded if it
+    was closed by the server.
+    """
+    # ThreadedConnectionPool raises instead of waiting when it is exhausted
+    _pool_slots.acquire()
+    try:
+        db_pool = get_db_pool()
+        conn = db_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            db_pool.putconn(conn, close=bool(conn.closed))
+    finally:
+        _pool_slots.release()
+
+def notify_account_changed(cur, user_email):
+    """Tells listeners that an account's row changed; delivered when the transaction commits."""
+    cur.execute("SELECT pg_notify(%s, %s)", (ACCOUNTS_CHANNEL, user_email))
+
 def setup_database():
     """Create all necessary tables if they don't exist."""
     commands = (
@@ -67,9 +121,109 @@ def setup_database():
             full_email_body TEXT,
             logged_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
         );
+        """,
+        # Gmail history cursor used for incremental syncs
+        """
+        ALTER TABLE connected_accounts ADD COLUMN IF NOT EXISTS history_id VARCHAR(32);
+        """,
+        # Bumped whenever the tokens change, so cached credentials can tell they are stale
+        """
+        ALTER TABLE connected_accounts ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW();
+        """,
+        # Triage queries read unhandled emails by status, most important and newest first
+        """
+        CREATE INDEX IF NOT EXISTS idx_unhandled_emails_triage
+            ON unhandled_emails (status, importance DESC, received_at DESC);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_not_found_refund_requests_customer
+            ON not_found_refund_requests (customer_email, logged_at DESC);
+        """,
+        # Keyset pages of the triage view (triage.py), newest first; the INCLUDE columns let
+        # filtered counts run as index-only scans
+        """
+        CREATE INDEX IF NOT EXISTS idx_unhandled_emails_received
+            ON unhandled_emails (received_at DESC, id DESC) INCLUDE (status, category, importance);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_unhandled_emails_status_received
+            ON unhandled_emails (status, received_at DESC, id DESC) INCLUDE (category, importance);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_not_found_refund_requests_logged
+            ON not_found_refund_requests (logged_at DESC, id DESC);
+        """,
+        # Work queue shared by listener replicas (see job_queue.py)
+        """
+        CREATE TABLE IF NOT EXISTS email_jobs (
+            id BIGSERIAL PRIMARY KEY,
+            account_email VARCHAR(255) NOT NULL,
+            message_id VARCHAR(64) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            attempts SMALLINT NOT NULL DEFAULT 0,
+            visible_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            claimed_by VARCHAR(255),
+            last_error TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            UNIQUE (account_email, message_id)
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_email_jobs_claimable
+            ON email_jobs (account_email, visible_at)
+            WHERE status IN ('queued', 'processing');
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_email_jobs_finished
+            ON email_jobs (updated_at)
+            WHERE status IN ('done', 'failed');
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS account_leases (
+            user_email VARCHAR(255) PRIMARY KEY,
+            owner VARCHAR(255) NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS listener_replicas (
+            worker_id VARCHAR(255) PRIMARY KEY,
+            last_seen TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+        );
+        """,
+        # Recent message fingerprints for duplicate suppression (see dedup.py)
+        """
+        CREATE TABLE IF NOT EXISTS email_fingerprints (
+            account_email VARCHAR(255) NOT NULL,
+            message_id VARCHAR(64) NOT NULL,
+            sender VARCHAR(255) NOT NULL,
+            thread_id VARCHAR(64),
+            content_hash CHAR(64) NOT NULL,
+            simhash BIGINT,
+            seen_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (account_email, message_id)
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_email_fingerprints_sender
+            ON email_fingerprints (account_email, sender, seen_at);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_email_fingerprints_seen_at
+            ON email_fingerprints (seen_at);
         """
     )
     
+    if os.getenv("TRIAGE_FULL_TEXT", "0") == "1":
+        # Same expression as triage.SEARCH_VECTOR, which the search queries use
+        commands += (
+            """
+            CREATE INDEX IF NOT EXISTS idx_unhandled_emails_search ON unhandled_emails
+                USING GIN (to_tsvector('english', coalesce(subject, '') || ' ' || coalesce(body, '')));
+            """,
+        )
+    
     conn = None
     try:
         conn = get_db_connection()
@@ -0,0 +1,206 @@
+"""
+Duplicate and thread-aware suppression, run before any model sees an email.
+
+Within one batch, several unread messages of the same thread collapse into the
+newest one, which carries the text of the others, so the thread gets one reply.
+The folded messages are listed in the kept email's 'collapsed' and share its
+outcome. Across batches, only content counts, never the thread alone: a later
+reply in a thread (e.g. the order id we asked for) is a new message. A message
+is dropped if the same sender sent the same account an identical (SHA-256 of
+the normalized text) or nearly identical (64-bit SimHash within
+DEDUP_MAX_DISTANCE bits) message within DEDUP_WINDOW_SECONDS.
+
+Recent fingerprints are kept in a bounded in-memory LRU per (account, sender).
+They are also stored in the `email_fingerprints` table, so restarts and other
+replicas see them too. Suppressed emails are not answered but count as handled,
+so they are marked as read.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from psycopg2.extras import execute_values
+from database import pooled_connection
+from metrics import Counter
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_WINDOW_SECONDS = int(os.getenv("DEDUP_WINDOW_SECONDS", "3600"))
+# Maximum differing SimHash bits for two bodies to count as the same message
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "3"))
+# Senders whose fingerprints are kept in memory
+DEDUP_INDEX_SIZE = int(os.getenv("DEDUP_INDEX_SIZE", "10000"))
+# Store fingerprints in Postgres; off keeps them in this process's memory only
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "1") == "1"
+# SimHash is unreliable on very short texts, so those only match exactly
+MIN_SIMHASH_TOKENS = 8
+SHINGLE_SIZE = 3
+
+SUPPRESSED = Counter('emails_suppressed_total', 'Emails dropped before inference, by reason.')
+
+_WORD = re.compile(r'\w+')
+_ADDRESS = re.compile(r'<([^>]+)>')
+_BIT_POSITIONS = np.arange(64, dtype=np.uint64)
+
+_index = OrderedDict() # (account, sender) -> [(message_id, content_hash, simhash, seen_at)]
+_index_lock = threading.Lock()
+_last_cleanup = 0.0
+
+def _sender(email):
+    match = _ADDRESS.search(email.get('from') or '')
+    return (match.group(1) if match else email.get('from') or '').strip().lower()
+
+def fingerprint(text):
+    """Returns (content_hash, simhash or None) for a cleaned body."""
+    tokens = _WORD.findall(text.lower())
+    content_hash = hashlib.sha256(' '.join(tokens).encode('utf-8')).hexdigest()
+    if len(tokens) < MIN_SIMHASH_TOKENS:
+        return content_hash, None
+    shingles = {' '.join(tokens[i:i + SHINGLE_SIZE]) for i in range(len(tokens) - SHINGLE_SIZE + 1)}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=8).digest(), 'little') for s in shingles],
+        dtype=np.uint64
+    )
+    # Each bit is set when most shingles have it set
+    votes = ((hashes[:, None] >> _BIT_POSITIONS) & np.uint64(1)).sum(axis=0)
+    simhash = 0
+    for bit in np.nonzero(votes * 2 > len(hashes))[0]:
+        simhash |= 1 << int(bit)
+    return content_hash, simhash
+
+def _to_signed(value):
+    # Postgres BIGINT is signed
+    return value - (1 << 64) if value is not None and value >= 1 << 63 else value
+
+def _to_unsigned(value):
+    return value & ((1 << 64) - 1) if value is not None else None
+
+def _is_duplicate(message_id, content_hash, simhash, previous, now):
+    for prev_id, prev_hash, prev_simhash, seen_at in previous:
+        # A retried message must not be suppressed by its own earlier fingerprint
+        if prev_id == message_id or now - seen_at > DEDUP_WINDOW_SECONDS:
+            continue
+        if prev_hash == content_hash:
+            return 'duplicate'
+        if simhash is not None and prev_simhash is not None and bin(simhash ^ prev_simhash).count('1') <= DEDUP_MAX_DISTANCE:
+            return 'near_duplicate'
+    return None
+
+def _collapse_threads(entries):
+    """Keeps the newest unread message per (account, thread) and folds the others' text into it."""
+    dropped = {}
+    threads = {}
+    for i, (account, email) in enumerate(entries):
+        threads.setdefault((account, email.get('threadId')), []).append(i)
+    for (_, thread_id), indexes in threads.items():
+        if thread_id is None or len(indexes) < 2:
+            continue
+        indexes.sort(key=lambda i: int(entries[i][1].get('internalDate') or 0))
+        kept = entries[indexes[-1]][1]
+        kept['clean_body'] = '\n\n'.join(entries[i][1]['clean_body'] for i in indexes)
+        # The raw text goes into unhandled_emails, so a person sees every message of the thread
+        kept['body'] = '\n\n'.join(entries[i][1]['body'] for i in indexes)
+        kept.pop('features', None)
+        kept['collapsed'] = [entries[i][1] for i in indexes[:-1]]
+        for i in indexes[:-1]:
+            entries[i][1]['collapsed_into'] = kept['id']
+            dropped[i] = 'thread'
+    return dropped
+
+def _load_from_database(account, senders, now):
+    """Fetches the window's fingerprints for senders not in memory; empty on database errors."""
+    loaded = {sender: [] for sender in senders}
+    try:
+        with pooled_connection() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT sender, message_id, content_hash, simhash, EXTRACT(EPOCH FROM seen_at)
+                FROM email_fingerprints
+                WHERE account_email = %s AND sender = ANY(%s) AND seen_at > NOW() - %s * INTERVAL '1 second'
+                """,
+                (account, list(senders), DEDUP_WINDOW_SECONDS)
+            )
+            for sender, message_id, content_hash, simhash, seen_at in cur.fetchall():
+                loaded[sender].append((message_id, content_hash, _to_unsigned(simhash), float(seen_at)))
+    except Exception as error:
+        logging.warning(f"Could not load email fingerprints, using in-memory ones only: {error}")
+    return loaded
+
+def _save_to_database(rows, now):
+    global _last_cleanup
+    try:
+        with pooled_connection() as conn, conn.cursor() as cur:
+            execute_values(
+                cur,
+                """
+                INSERT INTO email_fingerprints (account_email, sender, message_id, thread_id, content_hash, simhash)
+                VALUES %s
+                ON CONFLICT (account_email, message_id) DO NOTHING
+                """,
+                rows
+            )
+            if now - _last_cleanup > DEDUP_WINDOW_SECONDS:
+                _last_cleanup = now
+                cur.execute(
+                    "DELETE FROM email_fingerprints WHERE seen_at < NOW() - %s * INTERVAL '1 second'",
+                    (2 * DEDUP_WINDOW_SECONDS,)
+                )
+    except Exception as error:
+        logging.warning(f"Could not store email fingerprints: {error}")
+
+def find_duplicates(entries):
+    """
+    Decides which emails of a batch to drop.
+
+    `entries` is a list of (account_email, email) with cleaned bodies. Returns
+    {index: reason} for the emails to skip; reasons are 'thread', 'duplicate'
+    and 'near_duplicate'. Emails folded into a newer one of their thread have
+    'collapsed_into' set and must be finished together with that email.
+    """
+    if not DEDUP_ENABLED or not entries:
+        return {}
+    now = time.time()
+    dropped = _collapse_threads(entries)
+
+    candidates = []
+    for i, (account, email) in enumerate(entries):
+        if i not in dropped:
+            content_hash, simhash = fingerprint(email['clean_body'])
+            candidates.append((i, account, _sender(email), content_hash, simhash))
+
+    with _index_lock:
+        missing = {}
+        for _, account, sender, _, _ in candidates:
+            if (account, sender) not in _index:
+                missing.setdefault(account, set()).add(sender)
+    for account, senders in (missing.items() if DEDUP_PERSIST else []):
+        loaded = _load_from_database(account, senders, now)
+        with _index_lock:
+            for sender, previous in loaded.items():
+                _index.setdefault((account, sender), previous)
+
+    rows = []
+    with _index_lock:
+        for i, account, sender, content_hash, simhash in candidates:
+            email = entries[i][1]
+            previous = _index.setdefault((account, sender), [])
+            _index.move_to_end((account, sender))
+            reason = _is_duplicate(email['id'], content_hash, simhash, previous, now)
+            if reason:
+                dropped[i] = reason
+                continue
+            previous[:] = [entry for entry in previous if now - entry[3] <= DEDUP_WINDOW_SECONDS]
+            previous.append((email['id'], content_hash, simhash, now))
+            rows.append((account, sender, email['id'], email.get('threadId'), content_hash, _to_signed(simhash)))
+        while len(_index) > DEDUP_INDEX_SIZE:
+            _index.popitem(last=False)
+
+    if rows and DEDUP_PERSIST:
+        _save_to_database(rows, now)
+    for i, reason in dropped.items():
+        SUPPRESSED.inc(reason=reason)
+        logging.info(f"Skipping email {entries[i][1]['id']} from {entries[i][1].get('from')}: {reason}.")
+    return dropped
@@ -0,0 +1,143 @@
+"""
+Extracts and cleans the text of Gmail messages.
+
+`extract_body` picks the part to use from a `messages.get` payload and decodes
+only that one. `clean_body` reduces it to what the customer actually wrote: one
+precompiled regex scan finds quoted blocks, "On ... wrote:" attributions and
+the start of a signature or forwarded history. Every alternative is bounded
+to one or two lines, so a multi-megabyte thread costs a single linear pass
+with no backtracking across the body.
+"""
+import base64
+import html
+import re
+
+# Runs of quoted lines and reply attributions are dropped; a signature or
+# unquoted earlier history (Outlook does not quote it) ends the message.
+# Each quoted line can only match one way (up to its newline), so runs do not backtrack.
+_REMOVED = re.compile(
+    r'(?P<quoted>(?:^[ \t]*>[^\n]*(?:\n|\Z))+)'
+    r'|(?P<attribution>^[ \t]*On\b[^\n]*(?:\n[^\n]*)??wrote:[ \t]*\r?$\n?)'
+    r'|(?P<stop>^(?:-- |-----Original Message-----|-+ ?Forwarded message ?-+|_{32})\r?$)',
+    re.MULTILINE
+)
+_TAG = re.compile(r'<[^>]*>')
+_BLANK_LINES = re.compile(r'\n[ \t\r]*\n(?:[ \t\r]*\n)+')
+# HTML elements whose content is never part of the new message
+_SKIPPED_ELEMENT = re.compile(r'<(blockquote|style|script|head)\b[^>]*>', re.IGNORECASE)
+_BLOCKQUOTE_TAG = re.compile(r'<(/?)blockquote\b[^>]*>', re.IGNORECASE)
+_CLOSING_TAG = {
+    name: re.compile(rf'</{name}\s*>', re.IGNORECASE) for name in ('style', 'script', 'head')
+}
+_LINE_BREAK_TAG = re.compile(r'<(?:br|/?p|/?div|/li|/tr|/h[1-6])\b[^>]*>', re.IGNORECASE)
+
+def _decode(data, max_bytes=None):
+    if max_bytes is not None:
+        # Every 4 base64 characters hold 3 bytes, so a prefix decodes on its own
+        data = data[:-(-max_bytes // 3) * 4]
+    # A multibyte character cut at the end becomes a replacement character
+    return base64.urlsafe_b64decode(data).decode('utf-8', errors='replace')
+
+def extract_body(payload, max_bytes=None):
+    """
+    Returns (text, mime_type) for a message payload.
+
+    The first text/plain part wins. The first text/html part is only decoded if
+    the message has no plain text at all. Attachments are skipped. With
+    `max_bytes`, only that much of the part is decoded.
+    """
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('filename'):
+            continue
+        data = part.get('body', {}).get('data')
+        mime_type = part.get('mimeType', '')
+        if data and mime_type == 'text/plain':
+            return _decode(data, max_bytes), mime_type
+        if data and mime_type == 'text/html' and html_part is None:
+            html_part = part
+        # Reversed so parts are visited in document order
+        stack.extend(reversed(part.get('parts', [])))
+    if html_part is not None:
+        return _decode(html_part['body']['data'], max_bytes), 'text/html'
+    return '', None
+
+def text_part_size(payload):
+    """
+    Returns the size in bytes of the part `extract_body` would decode, from
+    part sizes alone (e.g. a response with a field mask and no data).
+    Attachments do not count. 0 if there is no text part.
+    """
+    html_size = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('filename'):
+            continue
+        size = int(part.get('body', {}).get('size') or 0)
+        mime_type = part.get('mimeType', '')
+        if size and mime_type == 'text/plain':
+            return size
+        if size and mime_type == 'text/html' and html_size is None:
+            html_size = size
+        stack.extend(reversed(part.get('parts', [])))
+    return html_size or 0
+
+def has_attachments(payload):
+    """True if any part of the payload is a file attachment."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('filename'):
+            return True
+        stack.extend(part.get('parts', []))
+    return False
+
+def html_to_text(html_body):
+    """Converts an HTML body to text, turning block tags into line breaks and dropping quoted blockquotes."""
+    out = []
+    position = 0
+    while True:
+        match = _SKIPPED_ELEMENT.search(html_body, position)
+        if match is None:
+            out.append(html_body[position:])
+            break
+        out.append(html_body[position:match.start()])
+        name = match.group(1).lower()
+        position = len(html_body)
+        if name == 'blockquote':
+            # Blockquotes nest, so only their own tags are counted to find the end
+            depth = 1
+            for tag in _BLOCKQUOTE_TAG.finditer(html_body, match.end()):
+                depth += -1 if tag.group(1) else 1
+                if depth == 0:
+                    position = tag.end()
+                    break
+        else:
+            closing = _CLOSING_TAG[name].search(html_body, match.end())
+            if closing:
+                position = closing.end()
+    text = _LINE_BREAK_TAG.sub('\n', ''.join(out))
+    return html.unescape(_TAG.sub('', text))
+
+def clean_body(raw_body, is_html=False):
+    """Returns the newly written text of an email body, without quoted history or signature."""
+    if is_html:
+        raw_body = html_to_text(raw_body)
+
+    kept = []
+    position = 0
+    for match in _REMOVED.finditer(raw_body):
+        kept.append(raw_body[position:match.start()])
+        position = match.end()
+        if match.lastgroup == 'stop':
+            break
+    else:
+        kept.append(raw_body[position:])
+
+    text = ''.join(kept)
+    if '<' in text:
+        text = _TAG.sub('', text)
+    return _BLANK_LINES.sub('\n\n', text).strip()
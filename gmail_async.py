@@ -0,0 +1,259 @@
+"""
+Asyncio Gmail transport, used by the listener when GMAIL_TRANSPORT=async.
+
+All accounts share one `httpx.AsyncClient` (HTTP/2, so many requests are
+multiplexed over a few connections). It runs on a single event loop in a
+background thread. Each account gets a `GmailSession` holding its access token
+and a quota bucket. The bucket spends Gmail's per-method quota units at no
+more than GMAIL_QUOTA_UNITS_PER_SECOND. Concurrent requests that find the token
+expired share a single refresh.
+
+The blocking helpers in gmail_service accept a session wherever they accept a
+googleapiclient service, so the rest of the pipeline is unchanged. Needs
+`pip install "httpx[http2]"`.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from metrics import Counter
+
+GMAIL_API = 'https://gmail.googleapis.com/gmail/v1/users/me'
+TOKEN_URI = 'https://oauth2.googleapis.com/token'
+# Gmail allows 250 quota units per user per second
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "250"))
+# Connections in the shared pool; with HTTP/2 each carries many concurrent requests
+GMAIL_MAX_CONNECTIONS = int(os.getenv("GMAIL_MAX_CONNECTIONS", "20"))
+# Concurrent messages.get requests per account
+GMAIL_FETCH_CONCURRENCY = int(os.getenv("GMAIL_FETCH_CONCURRENCY", "25"))
+GMAIL_MAX_RETRIES = 4
+# Tokens are refreshed this long before they expire
+TOKEN_REFRESH_MARGIN = 60
+
+# Quota units per method, from Gmail's usage limits
+QUOTA_UNITS = {
+    'users.getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'messages.send': 100
+}
+
+TOKEN_REFRESHES = Counter('gmail_token_refreshes_total', 'OAuth access token refreshes, by account.')
+RETRIES = Counter('gmail_request_retries_total', 'Gmail requests retried after rate limiting or server errors, by status.')
+
+_loop = None
+_loop_lock = threading.Lock()
+_http = None
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+class GmailHttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Gmail returned {status}: {message}")
+        self.status = status
+
+def _event_loop():
+    """Returns the transport's event loop, starting its thread on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='gmail-async', daemon=True).start()
+    return _loop
+
+def run(coroutine):
+    """Runs a coroutine on the transport's loop and waits for its result (from any other thread)."""
+    return asyncio.run_coroutine_threadsafe(coroutine, _event_loop()).result()
+
+def _client():
+    # Created on the loop's thread, on first use
+    global _http
+    if _http is None:
+        import httpx
+        _http = httpx.AsyncClient(
+            http2=True,
+            timeout=30,
+            limits=httpx.Limits(max_connections=GMAIL_MAX_CONNECTIONS, max_keepalive_connections=GMAIL_MAX_CONNECTIONS)
+        )
+    return _http
+
+class _QuotaBucket:
+    """Token bucket over quota units; waiters are served in order."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.units = rate
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, units):
+        units = min(units, self.rate)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.units = min(self.rate, self.units + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.units >= units:
+                    self.units -= units
+                    return
+                await asyncio.sleep((units - self.units) / self.rate)
+
+def _retry_delay(response, attempt):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return min(32, 2 ** attempt) + random.random()
+
+def _is_retryable(response):
+    if response.status_code == 429 or response.status_code >= 500:
+        return True
+    # Gmail also reports per-user rate limits as 403s
+    return response.status_code == 403 and 'ateLimitExceeded' in response.text
+
+class GmailSession:
+    """One account on the shared client: its OAuth tokens, refresh lock and quota bucket."""
+
+    def __init__(self, user_email, access_token, refresh_token, expiry, client_id, client_secret, on_refresh=None):
+        """
+        `expiry` is a Unix timestamp. `on_refresh(session)` is called in a
+        worker thread after each refresh, to store the new token.
+        """
+        self.user_email = user_email
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expiry = expiry
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._on_refresh = on_refresh
+        self._refresh_lock = asyncio.Lock()
+        self._quota = _QuotaBucket(GMAIL_QUOTA_UNITS_PER_SECOND)
+
+    def _token_valid(self):
+        return self.expiry - TOKEN_REFRESH_MARGIN > time.time()
+
+    async def _token(self):
+        if not self._token_valid():
+            await self._refresh(self.access_token)
+        return self.access_token
+
+    async def _refresh(self, stale_token):
+        """Refreshes the access token, unless another task already replaced `stale_token`."""
+        async with self._refresh_lock:
+            if self.access_token != stale_token and self._token_valid():
+                return
+            response = await _client().post(TOKEN_URI, data={
+                'grant_type': 'refresh_token',
+                'refresh_token': self.refresh_token,
+                'client_id': self._client_id,
+                'client_secret': self._client_secret
+            })
+            if response.status_code != 200:
+                raise GmailHttpError(response.status_code, f"token refresh failed: {response.text}")
+            data = response.json()
+            self.access_token = data['access_token']
+            self.expiry = time.time() + data.get('expires_in', 3600)
+            # A new refresh token is only sometimes issued
+            self.refresh_token = data.get('refresh_token') or self.refresh_token
+            TOKEN_REFRESHES.inc(account=self.user_email)
+            logging.info(f"Refreshed access token for {self.user_email}.")
+            if self._on_refresh:
+                await asyncio.get_running_loop().run_in_executor(None, self._on_refresh, self)
+
+    async def request(self, method_name, http_method, path, params=None, body=None):
+        """Sends one Gmail API request, retrying rate limits, server errors and one expired token."""
+        refreshed = False
+        for attempt in range(GMAIL_MAX_RETRIES + 1):
+            await self._quota.acquire(QUOTA_UNITS[method_name])
+            token = await self._token()
+            response = await _client().request(
+                http_method, GMAIL_API + path, params=params, json=body,
+                headers={'Authorization': f'Bearer {token}'}
+            )
+            if response.status_code == 401 and not refreshed:
+                refreshed = True
+                await self._refresh(token)
+                continue
+            if _is_retryable(response) and attempt < GMAIL_MAX_RETRIES:
+                RETRIES.inc(status=str(response.status_code))
+                await asyncio.sleep(_retry_delay(response, attempt))
+                continue
+            if response.status_code >= 400:
+                raise GmailHttpError(response.status_code, response.text)
+            return response.json() if response.content else {}
+
+    # --- Gmail API methods (coroutines) ---
+
+    async def get_profile(self):
+        return await self.request('users.getProfile', 'GET', '/profile')
+
+    async def list_messages(self, query, page_token=None):
+        params = {'q': query}
+        if page_token:
+            params['pageToken'] = page_token
+        return await self.request('messages.list', 'GET', '/messages', params=params)
+
+    async def list_history(self, start_history_id, page_token=None):
+        params = {'startHistoryId': start_history_id, 'historyTypes': 'messageAdded', 'labelId': 'INBOX'}
+        if page_token:
+            params['pageToken'] = page_token
+        return await self.request('history.list', 'GET', '/history', params=params)
+
+    async def get_message(self, message_id, format='full', **params):
+        """
+        `params` are further query parameters, e.g. `metadataHeaders` (a list,
+        sent as a repeated parameter) or `fields`.
+        """
+        return await self.request('messages.get', 'GET', f'/messages/{message_id}', params={'format': format, **params})
+
+    async def get_messages(self, message_ids, format='full', **params):
+        """Fetches messages concurrently, with get_message's parameters; returns ({id: message}, {id: error})."""
+        semaphore = asyncio.Semaphore(GMAIL_FETCH_CONCURRENCY)
+
+        async def fetch(message_id):
+            async with semaphore:
+                return await self.get_message(message_id, format, **params)
+
+        results = await asyncio.gather(*(fetch(message_id) for message_id in message_ids), return_exceptions=True)
+        messages, errors = {}, {}
+        for message_id, result in zip(message_ids, results):
+            if isinstance(result, Exception):
+                errors[message_id] = result
+            else:
+                messages[message_id] = result
+        return messages, errors
+
+    async def modify(self, message_id, remove_label_ids):
+        return await self.request('messages.modify', 'POST', f'/messages/{message_id}/modify',
+                                  body={'removeLabelIds': remove_label_ids})
+
+    async def batch_modify(self, message_ids, remove_label_ids):
+        return await self.request('messages.batchModify', 'POST', '/messages/batchModify',
+                                  body={'ids': message_ids, 'removeLabelIds': remove_label_ids})
+
+    async def send(self, raw, thread_id):
+        return await self.request('messages.send', 'POST', '/messages/send', body={'raw': raw, 'threadId': thread_id})
+
+def get_session(user_email, access_token, refresh_token, expiry, client_id, client_secret, on_refresh=None):
+    """
+    Returns the account's session, creating it on first use.
+
+    The session outlives poll cycles, so a token it refreshed is reused. It is
+    replaced when the account's refresh token changes (e.g. it was reconnected).
+    """
+    with _sessions_lock:
+        session = _sessions.get(user_email)
+        if session is None or (session.refresh_token != refresh_token and expiry > session.expiry):
+            session = _sessions[user_email] = GmailSession(
+                user_email, access_token, refresh_token, expiry, client_id, client_secret, on_refresh
+            )
+        return session
+
+def drop_session(user_email):
+    """Forgets an account's session, e.g. after it was disconnected."""
+    with _sessions_lock:
+        _sessions.pop(user_email, None)
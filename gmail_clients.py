@@ -0,0 +1,156 @@
+"""
+Per-account Gmail clients kept across poll cycles.
+
+Building a client means decrypting both tokens, creating `Credentials` and
+building a service, so the result is cached per account. The cache entry is
+dropped when the account's `connected_accounts` row gets a newer `updated_at`
+than the entry has seen. It is also dropped when app.py sends a change
+notification (LISTEN/NOTIFY on `database.ACCOUNTS_CHANNEL`), e.g. on
+disconnect. Access tokens are refreshed TOKEN_REFRESH_MARGIN_SECONDS before
+they expire rather than after a request fails, and saved.
+"""
+import logging
+import os
+import select
+import threading
+from datetime import datetime, timedelta, timezone
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+import database
+import gmail_async
+import gmail_service
+from database import pooled_connection
+from security import encrypt_token_to_str, decrypt_token_from_str
+
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+
+_clients = {} # user_email -> _CachedClient
+_clients_lock = threading.Lock()
+
+class _CachedClient:
+    def __init__(self, updated_at, credentials, service):
+        self.updated_at = updated_at
+        self.credentials = credentials
+        self.service = service
+        self.refresh_lock = threading.Lock()
+
+def save_tokens(user_email, access_token, refresh_token, expiry):
+    """Stores an account's refreshed tokens, encrypted; returns the row's new updated_at."""
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE connected_accounts
+            SET access_token = %s, refresh_token = %s, token_expiry = %s, updated_at = NOW()
+            WHERE user_email = %s
+            RETURNING updated_at
+            """,
+            (encrypt_token_to_str(access_token), encrypt_token_to_str(refresh_token), expiry, user_email)
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def _utc_naive(moment):
+    # google-auth compares expiry as a naive UTC datetime
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+def _build(account, secrets, transport):
+    access_token = decrypt_token_from_str(account['access_token'])
+    refresh_token = decrypt_token_from_str(account['refresh_token'])
+    user_email = account['user_email']
+    if transport == 'async':
+        def on_refresh(session):
+            updated_at = save_tokens(session.user_email, session.access_token, session.refresh_token,
+                                     datetime.fromtimestamp(session.expiry, timezone.utc))
+            with _clients_lock:
+                entry = _clients.get(session.user_email)
+                if entry is not None and updated_at is not None:
+                    entry.updated_at = updated_at
+        # The session refreshes its own token, once, shortly before it expires
+        session = gmail_async.get_session(
+            user_email, access_token, refresh_token, account['token_expiry'].timestamp(),
+            secrets['client_id'], secrets['client_secret'], on_refresh=on_refresh
+        )
+        return _CachedClient(account.get('updated_at'), None, session)
+
+    credentials = Credentials(
+        token=access_token,
+        refresh_token=refresh_token,
+        token_uri='https://oauth2.googleapis.com/token',
+        client_id=secrets['client_id'],
+        client_secret=secrets['client_secret'],
+        scopes=gmail_service.SCOPES,
+        expiry=_utc_naive(account['token_expiry'])
+    )
+    return _CachedClient(account.get('updated_at'), credentials, gmail_service.build_service(credentials))
+
+def _refresh_if_expiring(user_email, entry):
+    credentials = entry.credentials
+    margin = timedelta(seconds=TOKEN_REFRESH_MARGIN_SECONDS)
+    if credentials is None or (credentials.expiry and credentials.expiry - datetime.utcnow() > margin):
+        return
+    with entry.refresh_lock:
+        if credentials.expiry and credentials.expiry - datetime.utcnow() > margin:
+            return
+        logging.info(f"Refreshing token for {user_email}...")
+        credentials.refresh(Request())
+        updated_at = save_tokens(user_email, credentials.token, credentials.refresh_token,
+                                 credentials.expiry.replace(tzinfo=timezone.utc))
+        if updated_at is not None:
+            entry.updated_at = updated_at
+        logging.info("Token refreshed and saved securely.")
+
+def get_client(account, secrets, transport='blocking'):
+    """
+    Returns the account's Gmail client: a googleapiclient service, or a
+    `gmail_async.GmailSession` with transport='async'. It is built on first use
+    and rebuilt only once the account's row is newer than the cached one.
+    """
+    user_email = account['user_email']
+    updated_at = account.get('updated_at')
+    with _clients_lock:
+        entry = _clients.get(user_email)
+        if entry is not None and updated_at is not None and entry.updated_at is not None and updated_at > entry.updated_at:
+            entry = None
+    if entry is None:
+        if transport == 'async':
+            gmail_async.drop_session(user_email)
+        entry = _build(account, secrets, transport)
+        with _clients_lock:
+            _clients[user_email] = entry
+    _refresh_if_expiring(user_email, entry)
+    return entry.service
+
+def invalidate(user_email):
+    """Drops the cached client of an account."""
+    with _clients_lock:
+        _clients.pop(user_email, None)
+    gmail_async.drop_session(user_email)
+
+def listen_for_changes(on_change, stop):
+    """
+    Invalidates cached clients as app.py reports account changes, until `stop`
+    is set. `on_change(user_email)` is called after each. Runs in the calling
+    thread, with its own connection, and reconnects after errors.
+    """
+    while not stop.is_set():
+        conn = None
+        try:
+            conn = database.get_db_connection()
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {database.ACCOUNTS_CHANNEL};")
+            while not stop.is_set():
+                if select.select([conn], [], [], 5) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    user_email = conn.notifies.pop(0).payload
+                    logging.info(f"Account {user_email} changed, dropping its cached Gmail client.")
+                    invalidate(user_email)
+                    on_change(user_email)
+        except Exception as error:
+            logging.error(f"Account change listener failed, reconnecting: {error}")
+            stop.wait(5)
+        finally:
+            if conn is not None:
+                conn.close()
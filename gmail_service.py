@@ -1,10 +1,15 @@
 import base64
+import functools
+import json
 import os
-import re
 from email.mime.text import MIMEText
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.errors import HttpError
+import email_body
+import gmail_async
+from metrics import GMAIL_REQUEST_SECONDS, STAGE_SECONDS
 
 CLIENT_SECRETS_FILE = 'client_secret.json'
 SCOPES = [
@@ -12,60 +17,253 @@ SCOPES = [
     'https://www.googleapis.com/auth/gmail.modify',
     'https://www.googleapis.com/auth/gmail.send'
 ]
+# Messages fetched per HTTP batch request (Gmail accepts at most 100)
+GMAIL_BATCH_SIZE = int(os.getenv("GMAIL_BATCH_SIZE", "50"))
+# messages.batchModify accepts at most 1000 ids per call
+BATCH_MODIFY_LIMIT = 1000
+# 'two_phase' fetches metadata first and the MIME tree only for messages whose
+# text is under GMAIL_MAX_MESSAGE_BYTES; 'full' fetches everything in one call
+GMAIL_FETCH_MODE = os.getenv("GMAIL_FETCH_MODE", "two_phase")
+# Largest text part (plain, or HTML without plain) processed; attachments do not count
+GMAIL_MAX_MESSAGE_BYTES = int(os.getenv("GMAIL_MAX_MESSAGE_BYTES", str(2 * 1024 * 1024)))
+# At most this much of the chosen text part is decoded
+GMAIL_BODY_MAX_BYTES = int(os.getenv("GMAIL_BODY_MAX_BYTES", str(256 * 1024)))
+METADATA_HEADERS = ['From', 'To', 'Subject', 'In-Reply-To', 'List-Unsubscribe', 'Auto-Submitted', 'Precedence']
+# Only the MIME tree is needed from the second request; the headers came with the metadata
+BODY_FIELDS = 'id,payload(mimeType,filename,body,parts)'
+# Part types, names and sizes without any data, four levels deep (e.g. mixed > related > alternative > text)
+_PART = 'mimeType,filename,body/size'
+STRUCTURE_FIELDS = f'id,payload({_PART},parts({_PART},parts({_PART},parts({_PART},parts({_PART})))))'
 
+@functools.lru_cache(maxsize=1)
+def _discovery_document():
+    # Parsed once per process instead of on every build()
+    from googleapiclient.discovery_cache import get_static_doc
+    document = get_static_doc('gmail', 'v1')
+    return json.loads(document) if document else None
+
+def build_service(credentials):
+    """Builds a blocking Gmail client from the cached discovery document."""
+    document = _discovery_document()
+    if document is None:
+        return build('gmail', 'v1', credentials=credentials)
+    return build_from_document(document, credentials=credentials)
+
+def _http_status(error):
+    return error.status if isinstance(error, gmail_async.GmailHttpError) else error.resp.status
+
+@GMAIL_REQUEST_SECONDS.timed(method='messages.list')
 def fetch_unread_emails(service):
-    """Fetches a list of unread email messages."""
-    results = service.users().messages().list(userId='me', q='is:unread').execute()
-    messages = results.get('messages', [])
-    return messages
+    """Fetches a list of unread email messages, following every result page."""
+    messages = []
+    page_token = None
+    while True:
+        if isinstance(service, gmail_async.GmailSession):
+            results = gmail_async.run(service.list_messages('is:unread', page_token))
+        else:
+            results = service.users().messages().list(userId='me', q='is:unread', pageToken=page_token).execute()
+        messages.extend(results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return messages
+
+@GMAIL_REQUEST_SECONDS.timed(method='users.getProfile')
+def get_history_id(service):
+    """Returns the mailbox's current history id, the starting point for incremental syncs."""
+    if isinstance(service, gmail_async.GmailSession):
+        return gmail_async.run(service.get_profile())['historyId']
+    return service.users().getProfile(userId='me').execute()['historyId']
+
+@GMAIL_REQUEST_SECONDS.timed(method='history.list')
+def fetch_new_emails_since(service, start_history_id):
+    """
+    Lists unread inbox messages added since `start_history_id` via the history API.
+
+    Returns a (messages, latest_history_id) tuple, or None if Gmail no longer
+    has history that far back and the caller has to do a full resync.
+    """
+    messages = []
+    seen_ids = set()
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            if isinstance(service, gmail_async.GmailSession):
+                results = gmail_async.run(service.list_history(start_history_id, page_token))
+            else:
+                results = service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded'],
+                    labelId='INBOX',
+                    pageToken=page_token
+                ).execute()
+        except (HttpError, gmail_async.GmailHttpError) as error:
+            if _http_status(error) == 404:
+                return None
+            raise
+
+        latest_history_id = results.get('historyId', latest_history_id)
+        for record in results.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if 'UNREAD' in message.get('labelIds', []) and message['id'] not in seen_ids:
+                    seen_ids.add(message['id'])
+                    messages.append({'id': message['id'], 'threadId': message['threadId']})
+
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return messages, latest_history_id
+
+def sync_unread_emails(service, history_id=None):
+    """
+    Returns (messages, new_history_id) for an incremental sync.
+
+    With a stored history id only messages added since then are listed. Without
+    one, or when it has expired, all unread messages are listed instead.
+    """
+    if history_id:
+        result = fetch_new_emails_since(service, history_id)
+        if result is not None:
+            return result
+        print(f"History id {history_id} has expired, doing a full resync.")
+
+    # Read the cursor before listing so mail arriving during the listing is not missed
+    new_history_id = get_history_id(service)
+    return fetch_unread_emails(service), new_history_id
+
+def _fetch_messages(service, message_ids, batch_size=None, http=None, **params):
+    """
+    Runs `messages.get` with `params` for each id, in HTTP batch requests (or
+    concurrently on an async session). Returns {id: response}; failures are
+    reported and left out.
+    """
+    if isinstance(service, gmail_async.GmailSession):
+        # Concurrent requests over the shared HTTP/2 connections instead of batch requests
+        messages, errors = gmail_async.run(service.get_messages(message_ids, **params))
+        for message_id, error in errors.items():
+            print(f"Could not fetch message {message_id}: {error}")
+        return messages
 
+    batch_size = batch_size or GMAIL_BATCH_SIZE
+    results = {}
+
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            print(f"Could not fetch message {request_id}: {exception}")
+        else:
+            results[request_id] = response
+
+    for start in range(0, len(message_ids), batch_size):
+        batch = service.new_batch_http_request(callback=on_response)
+        for message_id in message_ids[start:start + batch_size]:
+            batch.add(service.users().messages().get(userId='me', id=message_id, **params), request_id=message_id)
+        batch.execute(http=http)
+    return results
+
+def _fetch_emails(service, message_ids, batch_size=None, http=None):
+    message_ids = list(dict.fromkeys(message_ids))
+    if GMAIL_FETCH_MODE == 'full':
+        messages = _fetch_messages(service, message_ids, batch_size, http, format='full')
+        return [_parse_message(messages[message_id]) for message_id in message_ids if message_id in messages]
+
+    # Phase 1: headers, labels and size only
+    metadata = _fetch_messages(service, message_ids, batch_size, http, format='metadata', metadataHeaders=METADATA_HEADERS)
+    # sizeEstimate includes attachments, so for large messages the size of the text part itself is checked
+    large = [
+        message_id for message_id in message_ids
+        if message_id in metadata and int(metadata[message_id].get('sizeEstimate') or 0) > GMAIL_MAX_MESSAGE_BYTES
+    ]
+    structures = _fetch_messages(service, large, batch_size, http, format='full', fields=STRUCTURE_FIELDS)
+    # Phase 2: the MIME tree of messages whose text is small enough to process; attachment data is never inline
+    wanted = [
+        message_id for message_id in message_ids
+        if message_id in metadata and (message_id not in large or (
+            message_id in structures
+            and email_body.text_part_size(structures[message_id]['payload']) <= GMAIL_MAX_MESSAGE_BYTES
+        ))
+    ]
+    bodies = _fetch_messages(service, wanted, batch_size, http, format='full', fields=BODY_FIELDS)
+
+    emails = []
+    for message_id in message_ids:
+        # Messages missing a response are left out, so they are fetched again on the next poll
+        if message_id not in metadata or (message_id in large and message_id not in structures) \
+                or (message_id in wanted and message_id not in bodies):
+            continue
+        body = bodies.get(message_id)
+        emails.append(_parse_message(metadata[message_id], body['payload'] if body else None))
+    return emails
+
+@GMAIL_REQUEST_SECONDS.timed(method='messages.get')
 def get_email_details(service, message_id):
     """
-    Gets the full details of a single email, with robust body parsing for
+    Gets the details of a single email, with robust body parsing for
     multipart messages.
     """
-    msg = service.users().messages().get(userId='me', id=message_id, format='full').execute()
-    
+    emails = _fetch_emails(service, [message_id])
+    if not emails:
+        raise RuntimeError(f"Could not fetch message {message_id}")
+    return emails[0]
+
+@GMAIL_REQUEST_SECONDS.timed(method='messages.get.batch')
+def get_email_details_batch(service, message_ids, batch_size=None, http=None):
+    """
+    Gets the details of many emails using one HTTP batch request per
+    `batch_size` messages instead of one round trip each.
+
+    With GMAIL_FETCH_MODE=two_phase, metadata is fetched first. Messages whose
+    text part is over GMAIL_MAX_MESSAGE_BYTES are returned without a body and
+    marked 'skip_reason', so they go to a person without being downloaded.
+    Large attachments alone do not make a message oversized.
+
+    Returns the parsed emails in the order of `message_ids`. Messages that could
+    not be fetched are reported and left out. `http` overrides the transport,
+    e.g. with `googleapiclient.http.HttpMockSequence` in tests.
+    """
+    return _fetch_emails(service, message_ids, batch_size, http)
+
+def _parse_message(msg, body_payload=None):
+    """
+    Turns a `messages.get` response into our email dict.
+
+    `msg` is a format='full' response, or a format='metadata' one with the
+    body taken from `body_payload`. A metadata response without a body
+    payload is a message whose text is too large to process.
+    """
     payload = msg['payload']
     headers = payload.get('headers', [])
     
     email_data = {
         'id': msg['id'],
         'threadId': msg['threadId'],
+        # Milliseconds since the epoch; orders messages within a thread
+        'internalDate': int(msg.get('internalDate') or 0),
+        'labelIds': msg.get('labelIds', []),
         'snippet': msg.get('snippet'),
+        'size': int(msg.get('sizeEstimate') or 0),
         'from': next((h['value'] for h in headers if h['name'].lower() == 'from'), 'N/A'),
         'to': next((h['value'] for h in headers if h['name'].lower() == 'to'), 'N/A'),
         'subject': next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'N/A'),
         'in_reply_to': next((h['value'] for h in headers if h['name'].lower() == 'in-reply-to'), None),
-        'body': ''
+        # Bulk and automated mail markers used by the pre-classifier
+        'list_unsubscribe': next((h['value'] for h in headers if h['name'].lower() == 'list-unsubscribe'), None),
+        'auto_submitted': next((h['value'] for h in headers if h['name'].lower() == 'auto-submitted'), None),
+        'precedence': next((h['value'] for h in headers if h['name'].lower() == 'precedence'), None)
     }
 
-    def find_body_parts(parts):
-        """Recursively search for the email body in multipart messages."""
-        body = ''
-        for part in parts:
-            if part.get('body') and part['body'].get('data'):
-                # Prioritize plain text over HTML
-                if part['mimeType'] == 'text/plain':
-                    data = part['body']['data']
-                    return base64.urlsafe_b64decode(data).decode('utf-8')
-                elif part['mimeType'] == 'text/html':
-                    data = part['body']['data']
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-
-            if 'parts' in part:
-                sub_body = find_body_parts(part['parts'])
-                if sub_body:
-                    return sub_body
-        return body
-    if 'parts' in payload:
-        email_data['body'] = find_body_parts(payload['parts'])
-    elif 'body' in payload and 'data' in payload['body']:
-        data = payload['body']['data']
-        email_data['body'] = base64.urlsafe_b64decode(data).decode('utf-8')
+    if body_payload is None and GMAIL_FETCH_MODE != 'full':
+        email_data['body'], email_data['body_type'] = '', None
+        email_data['skip_reason'] = 'oversized'
+        return email_data
 
+    body_payload = body_payload or payload
+    email_data['body'], email_data['body_type'] = email_body.extract_body(body_payload, GMAIL_BODY_MAX_BYTES)
+    if not email_data['body'].strip() and email_body.has_attachments(body_payload):
+        email_data['skip_reason'] = 'attachment_only'
     return email_data
 
+@GMAIL_REQUEST_SECONDS.timed(method='messages.send')
 def send_reply(service, to, subject, body, thread_id):
     """Sends a reply email."""
     message = MIMEText(body)
@@ -77,21 +275,42 @@ def send_reply(service, to, subject, body, thread_id):
         'threadId': thread_id
     }
     
-    sent_message = service.users().messages().send(userId='me', body=create_message).execute()
+    if isinstance(service, gmail_async.GmailSession):
+        sent_message = gmail_async.run(service.send(create_message['raw'], thread_id))
+    else:
+        sent_message = service.users().messages().send(userId='me', body=create_message).execute()
     print(f"Sent reply message ID: {sent_message['id']}")
 
+@GMAIL_REQUEST_SECONDS.timed(method='messages.modify')
 def mark_as_read(service, message_id):
     """Marks an email as read by removing the UNREAD label."""
-    service.users().messages().modify(
-        userId='me',
-        id=message_id,
-        body={'removeLabelIds': ['UNREAD']}
-    ).execute()
+    if isinstance(service, gmail_async.GmailSession):
+        gmail_async.run(service.modify(message_id, ['UNREAD']))
+    else:
+        service.users().messages().modify(
+            userId='me',
+            id=message_id,
+            body={'removeLabelIds': ['UNREAD']}
+        ).execute()
     print(f"Marked message {message_id} as read.")
 
-def clean_email_body(raw_body):
-    """A simple function to clean email content."""
-    body = re.sub(r'<[^>]+>', '', raw_body)
-    body = re.sub(r'On.*wrote:', '', body, flags=re.DOTALL)
-    body = '\n'.join([line for line in body.split('\n') if not line.strip().startswith('>')])
-    return body.strip()
\ No newline at end of file
+@GMAIL_REQUEST_SECONDS.timed(method='messages.batchModify')
+def mark_as_read_batch(service, message_ids, http=None):
+    """Marks many emails as read with as few `messages.batchModify` calls as possible."""
+    message_ids = list(dict.fromkeys(message_ids))
+    for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+        chunk = message_ids[start:start + BATCH_MODIFY_LIMIT]
+        if isinstance(service, gmail_async.GmailSession):
+            gmail_async.run(service.batch_modify(chunk, ['UNREAD']))
+        else:
+            service.users().messages().batchModify(
+                userId='me',
+                body={'ids': chunk, 'removeLabelIds': ['UNREAD']}
+            ).execute(http=http)
+    if message_ids:
+        print(f"Marked {len(message_ids)} message(s) as read.")
+
+@STAGE_SECONDS.timed(stage='clean')
+def clean_email_body(raw_body, is_html=False):
+    """Strips markup, quoted replies and signatures from an email body (see `email_body.clean_body`)."""
+    return email_body.clean_body(raw_body, is_html)
@@ -0,0 +1,182 @@
+"""
+Postgres-backed work queue shared by listener replicas.
+
+Every replica heartbeats into `listener_replicas` and leases a fair share of
+the connected accounts in `account_leases`; only the lease holder polls an
+account. Message ids found in Gmail become rows in `email_jobs` and are claimed
+with `FOR UPDATE SKIP LOCKED`, so a message is processed by one worker only.
+A claimed job stays invisible for JOB_VISIBILITY_TIMEOUT seconds. If it is not
+completed in that time (e.g. the worker crashed), another worker can claim it;
+failed jobs are retried with backoff up to JOB_MAX_ATTEMPTS times. Finished
+jobs are deleted JOB_RETENTION_SECONDS after they finished.
+"""
+import math
+import os
+import socket
+import time
+from psycopg2.extras import execute_values
+from database import pooled_connection
+
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+ACCOUNT_LEASE_SECONDS = int(os.getenv("ACCOUNT_LEASE_SECONDS", "180"))
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# Done and failed jobs are kept this long (for inspection) before they are purged
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(7 * 24 * 3600)))
+# Finished jobs are purged at most this often, by whichever replica renews its leases
+JOB_PURGE_INTERVAL_SECONDS = 3600
+
+_last_purge = 0.0
+
+def lease_accounts(user_emails, ttl=ACCOUNT_LEASE_SECONDS):
+    """
+    Renews and acquires account leases for this replica and returns the set of
+    accounts it owns.
+
+    Each live replica aims for an equal share of the accounts. Leases above
+    that share are released, so they can move to replicas that joined later.
+    """
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO listener_replicas (worker_id, last_seen) VALUES (%s, NOW())
+            ON CONFLICT (worker_id) DO UPDATE SET last_seen = NOW()
+            """,
+            (WORKER_ID,)
+        )
+        cur.execute(
+            "SELECT COUNT(*) FROM listener_replicas WHERE last_seen > NOW() - %s * INTERVAL '1 second'",
+            (ttl,)
+        )
+        share = math.ceil(len(user_emails) / max(1, cur.fetchone()[0]))
+
+        # Disconnected accounts
+        cur.execute(
+            "DELETE FROM account_leases WHERE owner = %s AND NOT (user_email = ANY(%s))",
+            (WORKER_ID, list(user_emails))
+        )
+        cur.execute(
+            "SELECT user_email FROM account_leases WHERE owner = %s AND expires_at > NOW() ORDER BY user_email",
+            (WORKER_ID,)
+        )
+        owned = [row[0] for row in cur.fetchall()]
+        keep, surplus = owned[:share], owned[share:]
+        if surplus:
+            cur.execute("DELETE FROM account_leases WHERE owner = %s AND user_email = ANY(%s)", (WORKER_ID, surplus))
+
+        candidates = keep + [email for email in user_emails if email not in owned]
+        cur.execute(
+            """
+            INSERT INTO account_leases (user_email, owner, expires_at)
+            SELECT user_email, %s, NOW() + %s * INTERVAL '1 second' FROM unnest(%s::text[]) AS user_email
+            ON CONFLICT (user_email) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+            WHERE account_leases.owner = EXCLUDED.owner OR account_leases.expires_at < NOW()
+            RETURNING user_email
+            """,
+            (WORKER_ID, ttl, candidates)
+        )
+        leased = {row[0] for row in cur.fetchall()}
+
+        # The insert may have picked up more free accounts than our share
+        extra = sorted(leased - set(keep))[max(0, share - len(keep)):]
+        if extra:
+            cur.execute("DELETE FROM account_leases WHERE owner = %s AND user_email = ANY(%s)", (WORKER_ID, extra))
+        _purge_finished_jobs(cur)
+        return leased - set(extra)
+
+def _purge_finished_jobs(cur):
+    """Deletes done and failed jobs older than JOB_RETENTION_SECONDS, at most once per JOB_PURGE_INTERVAL_SECONDS."""
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge < JOB_PURGE_INTERVAL_SECONDS:
+        return
+    _last_purge = now
+    cur.execute(
+        """
+        DELETE FROM email_jobs
+        WHERE status IN ('done', 'failed') AND updated_at < NOW() - %s * INTERVAL '1 second'
+        """,
+        (JOB_RETENTION_SECONDS,)
+    )
+
+def release_leases():
+    """Gives up all of this replica's leases, e.g. on shutdown."""
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM account_leases WHERE owner = %s", (WORKER_ID,))
+        cur.execute("DELETE FROM listener_replicas WHERE worker_id = %s", (WORKER_ID,))
+
+def enqueue(account_email, message_ids):
+    """Adds jobs for new message ids. Ids that already have a job, in any state, are ignored."""
+    if not message_ids:
+        return
+    with pooled_connection() as conn, conn.cursor() as cur:
+        execute_values(
+            cur,
+            """
+            INSERT INTO email_jobs (account_email, message_id) VALUES %s
+            ON CONFLICT (account_email, message_id) DO NOTHING
+            """,
+            [(account_email, message_id) for message_id in message_ids]
+        )
+
+def claim(account_email, limit, visibility_timeout=JOB_VISIBILITY_TIMEOUT):
+    """
+    Claims up to `limit` visible jobs of an account and returns them as
+    {'id', 'message_id', 'attempts'} dicts, oldest first.
+    """
+    with pooled_connection() as conn, conn.cursor() as cur:
+        # Jobs that timed out on their last allowed attempt are given up on
+        cur.execute(
+            """
+            UPDATE email_jobs SET status = 'failed', updated_at = NOW(),
+                last_error = COALESCE(last_error, 'visibility timeout expired')
+            WHERE account_email = %s AND status = 'processing' AND visible_at <= NOW() AND attempts >= %s
+            """,
+            (account_email, JOB_MAX_ATTEMPTS)
+        )
+        cur.execute(
+            """
+            UPDATE email_jobs SET
+                status = 'processing',
+                attempts = attempts + 1,
+                claimed_by = %s,
+                visible_at = NOW() + %s * INTERVAL '1 second',
+                updated_at = NOW()
+            WHERE id IN (
+                SELECT id FROM email_jobs
+                WHERE account_email = %s AND status IN ('queued', 'processing') AND visible_at <= NOW()
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, message_id, attempts
+            """,
+            (WORKER_ID, visibility_timeout, account_email, limit)
+        )
+        jobs = [{'id': row[0], 'message_id': row[1], 'attempts': row[2]} for row in cur.fetchall()]
+    return sorted(jobs, key=lambda job: job['id'])
+
+def complete(job_ids):
+    """Marks jobs as done so their messages are never processed again."""
+    if not job_ids:
+        return
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "UPDATE email_jobs SET status = 'done', updated_at = NOW() WHERE id = ANY(%s)",
+            (list(job_ids),)
+        )
+
+def fail(job_id, error):
+    """Puts a job back with exponential backoff, or marks it failed after JOB_MAX_ATTEMPTS."""
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE email_jobs SET
+                status = CASE WHEN attempts >= %s THEN 'failed' ELSE 'queued' END,
+                visible_at = NOW() + (30 * POWER(2, LEAST(attempts, 8))) * INTERVAL '1 second',
+                last_error = %s,
+                updated_at = NOW()
+            WHERE id = %s
+            """,
+            (JOB_MAX_ATTEMPTS, error[:2000], job_id)
+        )
@@ -0,0 +1,156 @@
+"""
+Persistent FAISS index over the knowledge base.
+
+Every Q/A pair in `knowledge_base/*.txt` is hashed, and the index directory keeps
+the FAISS index, the raw embeddings and a manifest of those hashes. When the
+knowledge base changes only new or edited entries are embedded again; when it
+has not changed, startup just loads the files. Rebuild offline with:
+
+    python kb_index.py [--force]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import faiss
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+KNOWLEDGE_BASE_DIR = os.getenv("KNOWLEDGE_BASE_DIR", "knowledge_base")
+KB_INDEX_DIR = os.getenv("KB_INDEX_DIR", "kb_index")
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+MANIFEST_FILE = "manifest.json"
+INDEX_FILE = "index.faiss"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+def load_entries(kb_dir=KNOWLEDGE_BASE_DIR):
+    """Parses every Q/A pair in the knowledge base files."""
+    entries = []
+    for path in sorted(glob.glob(os.path.join(kb_dir, '*.txt'))):
+        source = os.path.basename(path)
+        with open(path, 'r') as f:
+            text = f.read()
+
+        # Split text into question-answer pairs
+        for pair in re.split(r'\n(?=Q:)', text.strip()):
+            parts = pair.strip().split('\nA: ')
+            if len(parts) != 2:
+                continue
+            question = parts[0][3:] # Remove "Q: "
+            answer = parts[1]
+            digest = hashlib.sha256('\0'.join([source, question, answer]).encode('utf-8')).hexdigest()
+            entries.append({'source': source, 'question': question, 'answer': answer, 'hash': digest})
+    return entries
+
+def knowledge_base_signature(kb_dir=KNOWLEDGE_BASE_DIR):
+    """Cheap fingerprint of the knowledge base files (names and modification times)."""
+    return tuple(sorted((path, os.path.getmtime(path)) for path in glob.glob(os.path.join(kb_dir, '*.txt'))))
+
+def _read_manifest(index_dir):
+    path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def _replace_file(path, write):
+    """Writes through a temporary file so a crash never leaves a half-written index."""
+    tmp_path = path + '.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def build_index(embeddings, index_dir=KB_INDEX_DIR, kb_dir=KNOWLEDGE_BASE_DIR, force=False, model_id=EMBEDDING_MODEL):
+    """
+    Brings the on-disk index in line with the knowledge base and returns its manifest.
+
+    Embeddings of entries whose hash is already in the manifest are reused; only
+    new or changed entries go through the embedding model. Everything is
+    re-embedded when `model_id` differs from the one the index was built with.
+    """
+    entries = load_entries(kb_dir)
+    if not entries:
+        raise ValueError(f"No Q/A entries found in {kb_dir}.")
+    hashes = [entry['hash'] for entry in entries]
+
+    manifest = _read_manifest(index_dir)
+    cached_vectors = {}
+    if manifest is not None and manifest['model'] == model_id and not force:
+        if [entry['hash'] for entry in manifest['entries']] == hashes:
+            return manifest
+        old_vectors = np.load(os.path.join(index_dir, EMBEDDINGS_FILE), mmap_mode='r')
+        cached_vectors = {entry['hash']: old_vectors[i] for i, entry in enumerate(manifest['entries'])}
+
+    missing = [i for i, digest in enumerate(hashes) if digest not in cached_vectors]
+    print(f"Embedding {len(missing)} new or changed knowledge base entries ({len(entries) - len(missing)} reused)...")
+    new_vectors = embeddings.embed_documents([entries[i]['answer'] for i in missing]) if missing else []
+    new_vectors = dict(zip(missing, new_vectors))
+
+    vectors = np.array(
+        [new_vectors[i] if i in new_vectors else cached_vectors[digest] for i, digest in enumerate(hashes)],
+        dtype='float32'
+    )
+    index = faiss.IndexFlatL2(vectors.shape[1])
+    index.add(vectors)
+
+    os.makedirs(index_dir, exist_ok=True)
+    manifest = {
+        'model': model_id,
+        'version': hashlib.sha256(''.join(hashes).encode('utf-8')).hexdigest(),
+        'entries': entries
+    }
+
+    def write_embeddings(path):
+        # np.save appends .npy to names that lack it, so hand it an open file
+        with open(path, 'wb') as f:
+            np.save(f, vectors)
+
+    def write_manifest(path):
+        with open(path, 'w') as f:
+            json.dump(manifest, f)
+
+    _replace_file(os.path.join(index_dir, EMBEDDINGS_FILE), write_embeddings)
+    _replace_file(os.path.join(index_dir, INDEX_FILE), lambda path: faiss.write_index(index, path))
+    # The manifest goes last: it only describes an index that is fully on disk
+    _replace_file(os.path.join(index_dir, MANIFEST_FILE), write_manifest)
+    return manifest
+
+def load_vector_store(embeddings, index_dir=KB_INDEX_DIR, kb_dir=KNOWLEDGE_BASE_DIR, model_id=EMBEDDING_MODEL):
+    """
+    Returns (vector_store, version) for the knowledge base, updating the index first if needed.
+
+    `version` changes whenever the knowledge base content changes.
+    """
+    manifest = build_index(embeddings, index_dir, kb_dir, model_id=model_id)
+    index = faiss.read_index(os.path.join(index_dir, INDEX_FILE), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    documents = {
+        str(i): Document(page_content=entry['answer'], metadata={"source": entry['source'], "question": entry['question']})
+        for i, entry in enumerate(manifest['entries'])
+    }
+    vector_store = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(documents),
+        index_to_docstore_id={i: str(i) for i in range(len(documents))}
+    )
+    return vector_store, manifest['version']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the knowledge base vector index.")
+    parser.add_argument('--force', action='store_true', help="re-embed every entry instead of only changed ones")
+    args = parser.parse_args()
+
+    # Build with the same embedding backend the listener will use
+    import llm_service
+
+    print(f"Rebuilding knowledge base index ({llm_service.INFERENCE_BACKEND})...")
+    manifest = build_index(
+        llm_service.load_embeddings(),
+        force=args.force,
+        model_id=llm_service.embedding_model_id()
+    )
+    print(f"Index in '{KB_INDEX_DIR}' holds {len(manifest['entries'])} entries (version {manifest['version'][:12]}).")
@@ -1,62 +1,230 @@
+import logging
 import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain.docstore.document import Document
 from transformers import pipeline
-from langchain_community.vectorstores import FAISS
+import kb_index
+import model_client
+from answer_cache import AnswerCache
+from metrics import STAGE_SECONDS, Gauge
+
+# Categories are predicted in padded batches of this many emails
+CATEGORIZER_BATCH_SIZE = int(os.getenv("CATEGORIZER_BATCH_SIZE", "16"))
+CANDIDATE_LABELS = ["Question", "Refund Request", "Other"]
+# Model calls from all listener threads share this many inference threads
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "1"))
+# 'torch' (fp32), 'onnx' (ONNX Runtime through optimum) or 'int8' (dynamically quantized PyTorch)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+# Exported ONNX models are cached here so the export only happens once
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", "onnx_models")
+BACKENDS = ("torch", "onnx", "int8")
+# Load all models concurrently at listener startup and run a dummy inference, instead of on first use
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "0") == "1"
+
+# Knowledge base passages the QA model reads per question, and the cosine similarity they need
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "4"))
+RAG_MIN_SIMILARITY = float(os.getenv("RAG_MIN_SIMILARITY", "0.3"))
+# Minimum QA confidence for the chosen span to be sent as an answer
+RAG_MIN_QA_SCORE = float(os.getenv("RAG_MIN_QA_SCORE", "0.3"))
+# Weight of retrieval similarity against QA confidence when choosing between passages
+RAG_RETRIEVAL_WEIGHT = float(os.getenv("RAG_RETRIEVAL_WEIGHT", "0.3"))
+# The question sentences handed to the QA model are cut to this many characters
+QA_MAX_QUESTION_CHARS = int(os.getenv("QA_MAX_QUESTION_CHARS", "500"))
+
+CATEGORIZER_MODEL = "facebook/bart-large-mnli"
+QA_MODEL = "distilbert-base-cased-distilled-squad"
 
 # --- Global variables for models to avoid reloading ---
 _categorizer = None
-_rag_retriever = None
+_embeddings = None
+_vector_store = None
+_kb_signature = None
 _llm_qa = None
+_answer_cache = AnswerCache()
+Gauge(
+    'answer_cache_lookups',
+    'Answer cache lookups by result.',
+    lambda: {(('result', result),): count for result, count in _answer_cache.stats().items() if result != 'size'}
+)
+Gauge('answer_cache_size', 'Entries in the answer cache.', lambda: _answer_cache.stats()['size'])
+Gauge('models_ready', '1 once the models are loaded and warmed up.', lambda: int(is_ready()))
+# One lock per model, so loading one never blocks callers of another
+_categorizer_lock = threading.Lock()
+_retrieval_lock = threading.Lock()
+_qa_lock = threading.Lock()
+_ready = threading.Event()
+_inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix='inference')
+
+def _run_inference(fn, *args, **kwargs):
+    """
+    Runs a model call on the shared inference executor and waits for the result.
+
+    Account workers can run in parallel, but CPU-bound inference is funnelled
+    through a fixed number of threads so the cores are not oversubscribed.
+    """
+    return _inference_executor.submit(fn, *args, **kwargs).result()
 
 def _initialize_models():
-    """Initializes all AI models on first use."""
-    global _categorizer, _rag_retriever, _llm_qa
+    """Loads every model that is not loaded yet."""
+    _get_categorizer()
+    _get_retrieval()
+    _get_qa()
+
+def _check_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown INFERENCE_BACKEND '{backend}', expected one of {', '.join(BACKENDS)}.")
+
+def _load_pipeline(task, model_name, backend):
+    """Builds a transformers pipeline for `model_name` on the given inference backend."""
+    _check_backend(backend)
+    if backend == "torch":
+        return pipeline(task, model=model_name)
+
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    if backend == "onnx":
+        from optimum.onnxruntime import ORTModelForQuestionAnswering, ORTModelForSequenceClassification
+        model_class = ORTModelForQuestionAnswering if task == "question-answering" else ORTModelForSequenceClassification
+        export_dir = os.path.join(ONNX_MODEL_DIR, model_name.replace("/", "--"))
+        if os.path.isdir(export_dir):
+            model = model_class.from_pretrained(export_dir)
+        else:
+            print(f"Exporting {model_name} to ONNX...")
+            model = model_class.from_pretrained(model_name, export=True)
+            model.save_pretrained(export_dir)
+        return pipeline(task, model=model, tokenizer=tokenizer)
+
+    import torch
+    from transformers import AutoModelForQuestionAnswering, AutoModelForSequenceClassification
+    model_class = AutoModelForQuestionAnswering if task == "question-answering" else AutoModelForSequenceClassification
+    model = torch.quantization.quantize_dynamic(
+        model_class.from_pretrained(model_name), {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return pipeline(task, model=model, tokenizer=tokenizer)
+
+def load_categorizer(backend: str = INFERENCE_BACKEND):
+    """Loads the zero-shot categorization pipeline."""
+    return _load_pipeline("zero-shot-classification", CATEGORIZER_MODEL, backend)
+
+def load_qa(backend: str = INFERENCE_BACKEND):
+    """Loads the extractive question-answering pipeline."""
+    return _load_pipeline("question-answering", QA_MODEL, backend)
+
+def load_embeddings(backend: str = INFERENCE_BACKEND) -> HuggingFaceEmbeddings:
+    """Loads the sentence embedding model used for retrieval."""
+    _check_backend(backend)
+    if backend == "onnx":
+        return HuggingFaceEmbeddings(model_name=kb_index.EMBEDDING_MODEL, model_kwargs={"backend": "onnx"})
+
+    embeddings = HuggingFaceEmbeddings(model_name=kb_index.EMBEDDING_MODEL)
+    if backend == "int8":
+        import torch
+        torch.quantization.quantize_dynamic(embeddings.client, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return embeddings
 
+def embedding_model_id(backend: str = INFERENCE_BACKEND) -> str:
+    """Identifies the embedding model and backend, so the index is rebuilt when either changes."""
+    return kb_index.EMBEDDING_MODEL if backend == "torch" else f"{kb_index.EMBEDDING_MODEL}:{backend}"
+
+def _timed_load(name, loader):
+    print(f"Loading {name} ({INFERENCE_BACKEND})...")
+    start = time.perf_counter()
+    model = loader()
+    logging.info(f"Loaded {name} in {time.perf_counter() - start:.1f}s.")
+    return model
+
+def _get_categorizer():
+    """Returns the categorization pipeline, loading it on first use."""
+    global _categorizer
     if _categorizer is None:
-        print("Loading categorization model...")
-        _categorizer = pipeline(
-            "zero-shot-classification",
-            model="facebook/bart-large-mnli"
-        )
-    
-    if _rag_retriever is None:
-        print("Loading RAG embedding model and building vector store...")
-        # Create knowledge base from faq.txt
-        with open("knowledge_base/faq.txt", "r") as f:
-            faq_text = f.read()
-        
-        # Split text into question-answer pairs
-        qa_pairs = re.split(r'\n(?=Q:)', faq_text.strip())
-        documents = []
-        for pair in qa_pairs:
-            if pair.strip():
-                parts = pair.strip().split('\nA: ')
-                question = parts[0][3:] # Remove "Q: "
-                answer = parts[1]
-                # Create a LangChain document
-                doc = Document(page_content=answer, metadata={"source": "faq.txt", "question": question})
-                documents.append(doc)
-        
-        # Load embeddings model and create FAISS vector store
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-        vector_store = FAISS.from_documents(documents, embeddings)
-        _rag_retriever = vector_store.as_retriever()
+        with _categorizer_lock:
+            if _categorizer is None:
+                _categorizer = _timed_load("categorization model", load_categorizer)
+    return _categorizer
 
+def _get_retrieval():
+    """Loads the embedding model and the knowledge base index on first use and returns the embeddings."""
+    global _embeddings
+    if _vector_store is None:
+        with _retrieval_lock:
+            if _vector_store is None:
+                _embeddings = _timed_load("RAG embedding model", load_embeddings)
+                _load_vector_store()
+    return _embeddings
+
+def _get_qa():
+    """Returns the question-answering pipeline, loading it on first use."""
+    global _llm_qa
     if _llm_qa is None:
-        print("Loading Question-Answering model...")
-        _llm_qa = pipeline("question-answering", model="distilbert-base-cased-distilled-squad")
+        with _qa_lock:
+            if _llm_qa is None:
+                _llm_qa = _timed_load("Question-Answering model", load_qa)
+    return _llm_qa
 
-def categorize_email(email_body: str) -> str:
-    """Categorizes the email using a zero-shot classification model."""
-    _initialize_models()
-    
-    candidate_labels = ["Question", "Refund Request", "Other"]
-    result = _categorizer(email_body[:512], candidate_labels)
-    
-    # Simple logic to map the highest score to our categories
-    top_label = result['labels'][0]
+def warm_up():
+    """
+    Loads all models concurrently and runs one dummy inference through each,
+    so the first real email does not pay for loading or first-call setup.
+    Marks the worker as ready when done. With a model server, this waits for
+    the server to be warm instead.
+    """
+    start = time.perf_counter()
+    if model_client.MODEL_SERVER_ADDRESS:
+        while not model_client.call('ready'):
+            time.sleep(1)
+        _ready.set()
+        logging.info(f"Model server ready after {time.perf_counter() - start:.1f}s.")
+        return
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='warmup') as loaders:
+        for future in [loaders.submit(loader) for loader in (_get_categorizer, _get_retrieval, _get_qa)]:
+            future.result()
+
+    # On the inference executor, so its threads are the ones that get warmed up
+    _run_inference(_categorizer, "Hello, I have a question about my order.", CANDIDATE_LABELS)
+    _run_inference(_embeddings.embed_query, "How do I track my order?")
+    _run_inference(_llm_qa, question="How do I track my order?", context="Orders can be tracked from the account page.")
+    _ready.set()
+    logging.info(f"Models warmed up in {time.perf_counter() - start:.1f}s.")
+
+def is_ready() -> bool:
+    """True once the worker is warm; always true when MODEL_WARMUP is off and models load lazily."""
+    return _ready.is_set() or not MODEL_WARMUP
+
+def _load_vector_store():
+    """(Re)loads the knowledge base index and drops cached answers if its content changed."""
+    global _vector_store, _kb_signature
+    signature = kb_index.knowledge_base_signature()
+    _vector_store, version = kb_index.load_vector_store(_embeddings, model_id=embedding_model_id())
+    # Recorded only once the index loaded, so a failed reload is tried again on the next refresh
+    _kb_signature = signature
+    if version != _answer_cache.version:
+        _answer_cache.invalidate(version)
+
+def refresh_knowledge_base():
+    """
+    Re-indexes the knowledge base if its files changed since they were loaded.
+
+    Only changed entries are embedded again (see kb_index). Does nothing until
+    the models have been loaded, or when a model server owns them.
+    """
+    if _vector_store is None or kb_index.knowledge_base_signature() == _kb_signature:
+        return
+    with _retrieval_lock:
+        print("Knowledge base changed, updating vector store...")
+        _load_vector_store()
+
+def get_answer_cache_stats() -> dict:
+    """Returns the answer cache's size and hit/miss counters."""
+    return _answer_cache.stats()
+
+def _label_to_category(top_label: str) -> str:
+    """Maps the highest scoring zero-shot label to one of our categories."""
     if "Refund" in top_label:
         return "Refund"
     elif "Question" in top_label:
@@ -64,29 +232,146 @@ def categorize_email(email_body: str) -> str:
     else:
         return "Other"
 
-from typing import Optional
-
-def get_rag_answer(question: str) -> Optional[str]:
-    """Retrieves context from vector store and generates an answer."""
-    _initialize_models()
-    
-    # 1. Retrieve relevant documents from the vector store
-    docs = _rag_retriever.get_relevant_documents(question)
+@STAGE_SECONDS.timed(stage='categorize')
+def categorize_email(email_body: str) -> str:
+    """Categorizes the email using a zero-shot classification model."""
+    if model_client.MODEL_SERVER_ADDRESS:
+        return model_client.call('categorize', [email_body])[0]
+    categorizer = _get_categorizer()
     
-    if not docs:
+    result = _run_inference(categorizer, email_body[:512], CANDIDATE_LABELS)
+    return _label_to_category(result['labels'][0])
+
+@STAGE_SECONDS.timed(stage='categorize')
+def categorize_emails(email_bodies: List[str], batch_size: Optional[int] = None) -> List[str]:
+    """
+    Categorizes many emails with as few model passes as possible.
+
+    Bodies are sorted by length and fed to the zero-shot pipeline in padded
+    batches, so texts of similar length share a batch and little work is spent
+    on padding. The categories are returned in the same order as the input.
+    """
+    if not email_bodies:
+        return []
+    if model_client.MODEL_SERVER_ADDRESS:
+        return model_client.call('categorize', list(email_bodies))
+    categorizer = _get_categorizer()
+
+    batch_size = batch_size or CATEGORIZER_BATCH_SIZE
+    texts = [body[:512] for body in email_bodies]
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    categories = [None] * len(texts)
+
+    for start in range(0, len(order), batch_size):
+        bucket = order[start:start + batch_size]
+        # Zero-shot expands every text into one NLI pair per label, so the
+        # pipeline batch has to hold all pairs of the bucket at once.
+        results = _run_inference(
+            categorizer,
+            [texts[i] for i in bucket],
+            CANDIDATE_LABELS,
+            batch_size=len(bucket) * len(CANDIDATE_LABELS)
+        )
+        if isinstance(results, dict):
+            results = [results]
+        for index, result in zip(bucket, results):
+            categories[index] = _label_to_category(result['labels'][0])
+
+    return categories
+
+def get_rag_answer(question: str, embedding: Optional[List[float]] = None) -> Optional[str]:
+    """
+    Retrieves context from vector store and generates an answer.
+
+    With `embedding`, `question` is taken to be already extracted and
+    embedded (see processing_service.attach_features). Otherwise the question
+    sentences are extracted from it and embedded here.
+    Answers (including "no answer") are cached, so a repeated or nearly
+    identical question skips retrieval and the QA model. The QA model is only
+    loaded once a question actually needs it.
+    """
+    if model_client.MODEL_SERVER_ADDRESS:
+        return model_client.call('answer', (question, embedding))
+    _get_retrieval()
+
+    if embedding is None:
+        question = extract_question(question)
+        embedding = _embed_query(question)
+    found, answer = _answer_cache.get(question, embedding)
+    if found:
+        return answer
+
+    answer = _answer_question(question, embedding)
+    _answer_cache.put(question, answer, embedding)
+    return answer
+
+@STAGE_SECONDS.timed(stage='embed')
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """Embeds several texts in one pass of the retrieval model."""
+    if not texts:
+        return []
+    if model_client.MODEL_SERVER_ADDRESS:
+        return model_client.call('embed', list(texts))
+    return _run_inference(_get_retrieval().embed_documents, list(texts))
+
+@STAGE_SECONDS.timed(stage='embed')
+def _embed_query(text: str) -> List[float]:
+    """Embeds a question with the retrieval model."""
+    return _run_inference(_embeddings.embed_query, text)
+
+@STAGE_SECONDS.timed(stage='retrieve')
+def _retrieve(embedding: List[float]) -> list:
+    """
+    Returns up to RAG_TOP_K (document, similarity) pairs for an embedded
+    question, dropping passages below RAG_MIN_SIMILARITY.
+    """
+    results = _run_inference(_vector_store.similarity_search_with_score_by_vector, embedding, k=RAG_TOP_K)
+    # The index holds squared L2 distances between unit-length MiniLM vectors, so cosine = 1 - d/2
+    scored = [(doc, 1 - float(distance) / 2) for doc, distance in results]
+    return [(doc, similarity) for doc, similarity in scored if similarity >= RAG_MIN_SIMILARITY]
+
+@STAGE_SECONDS.timed(stage='qa')
+def _extract_answers(question: str, contexts: List[str]) -> List[dict]:
+    """Runs the QA model over every passage in one batched pass; one best span with its score per passage."""
+    inputs = [{'question': question, 'context': context} for context in contexts]
+    results = _run_inference(_get_qa(), inputs, batch_size=len(inputs))
+    # The pipeline unwraps single results
+    return [results] if isinstance(results, dict) else list(results)
+
+_SENTENCE_END = re.compile(r'(?<=[.?!])\s+|\n+')
+_QUESTION_START = re.compile(
+    r'^(?:how|what|when|where|why|who|which|can|could|do|does|did|is|are|will|would|should|may)\b', re.IGNORECASE
+)
+
+def extract_question(text: str) -> str:
+    """
+    Returns the sentences of an email that ask something, up to
+    QA_MAX_QUESTION_CHARS. Without any, the start of the email is used.
+    """
+    sentences = [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence.strip()]
+    asking = [s for s in sentences if s.endswith('?') or _QUESTION_START.match(s)]
+    if not asking:
+        return text[:QA_MAX_QUESTION_CHARS]
+    question = ''
+    for sentence in asking:
+        if question and len(question) + len(sentence) + 1 > QA_MAX_QUESTION_CHARS:
+            break
+        question = f"{question} {sentence}".strip()
+    return question[:QA_MAX_QUESTION_CHARS]
+
+def _answer_question(question: str, embedding: List[float]) -> Optional[str]:
+    """Runs retrieval and the QA model for an extracted question that was not in the cache."""
+    passages = _retrieve(embedding)
+    if not passages:
         return None # No relevant information found
-        
-    context = " ".join([doc.page_content for doc in docs])
-    
-    truncated_question = question[:1000]
-    
-    result = _llm_qa(question=truncated_question, context=context) # Use the truncated question
 
-    # Check if the answer is confident enough
-    if result['score'] > 0.3: # Confidence threshold
-        return result['answer']
-    else:
-        return None
+    results = _extract_answers(question, [doc.page_content for doc, _ in passages])
+    best_score, best = -1.0, None
+    for (_, similarity), result in zip(passages, results):
+        score = (1 - RAG_RETRIEVAL_WEIGHT) * result['score'] + RAG_RETRIEVAL_WEIGHT * similarity
+        if result['score'] >= RAG_MIN_QA_SCORE and score > best_score:
+            best_score, best = score, result
+    return best['answer'] if best else None
 
 def assess_importance(email_body: str) -> int:
     """A simple heuristic to assess importance for 'Other' emails."""
@@ -0,0 +1,168 @@
+"""
+Low-overhead in-process metrics exposed in the Prometheus text format.
+
+Counters and histograms are plain dictionaries guarded by a lock; recording a
+value costs a `perf_counter` call and a bisect, so they can sit on the
+per-email path. `start_http_server` serves them on `/metrics` from a daemon
+thread in the listener, next to a `/ready` readiness probe.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = []
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+class Counter:
+    """A monotonically increasing value per label set."""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+class Gauge:
+    """A value read from `callback` whenever the metrics are scraped."""
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            values = self.callback()
+        except Exception:
+            return lines
+        for labels, value in (values.items() if isinstance(values, dict) else [((), values)]):
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+class Histogram:
+    """Observations sorted into fixed buckets per label set."""
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._series = {} # labels -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of a `with` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """Decorator form of `time`."""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+        for key, values in series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            cumulative += values[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {values[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+def render():
+    """Returns every registered metric in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+# --- Metrics recorded by the listener ---
+
+STAGE_SECONDS = Histogram('email_stage_seconds', 'Time spent in each email pipeline stage.')
+GMAIL_REQUEST_SECONDS = Histogram('gmail_request_seconds', 'Duration of Gmail API calls.')
+ACCOUNT_POLL_SECONDS = Histogram('account_poll_seconds', 'Time to list and fetch the new emails of one account.')
+EMAILS_PROCESSED = Counter('emails_processed_total', 'Emails handled, by account and category.')
+EMAIL_ERRORS = Counter('email_errors_total', 'Failures while polling or handling emails.')
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/ready':
+            ready = self.server.ready_check()
+            self._respond(200 if ready else 503, b'ready\n' if ready else b'warming up\n', 'text/plain; charset=utf-8')
+        elif path == '/metrics':
+            self._respond(200, render().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            self.send_error(404)
+
+    def _respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would flood agent.log
+        pass
+
+def start_http_server(port, host='0.0.0.0', ready_check=lambda: True):
+    """
+    Serves `/metrics` and `/ready` on a daemon thread and returns the server.
+    `/ready` answers 200 while `ready_check()` is true and 503 otherwise.
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.ready_check = ready_check
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
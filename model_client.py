@@ -0,0 +1,56 @@
+"""
+Client side of the local model server (see model_server.py).
+
+`llm_service` sends its inference calls here when MODEL_SERVER_ADDRESS is set,
+so worker processes never load the models themselves. Connections are not
+safe to share between threads, so each thread opens its own.
+"""
+import os
+import threading
+from multiprocessing.connection import Client
+
+# Unix socket of a running model_server.py; unset means models are loaded in-process
+MODEL_SERVER_ADDRESS = os.getenv("MODEL_SERVER_ADDRESS")
+# Shared secret both sides use to authenticate connections (optional; the socket is also chmod 600)
+MODEL_SERVER_AUTHKEY = os.getenv("MODEL_SERVER_AUTHKEY")
+
+_local = threading.local()
+
+def get_authkey():
+    return MODEL_SERVER_AUTHKEY.encode() if MODEL_SERVER_AUTHKEY else None
+
+def _connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = Client(MODEL_SERVER_ADDRESS, family='AF_UNIX', authkey=get_authkey())
+    return conn
+
+def _drop_connection():
+    conn = getattr(_local, 'conn', None)
+    _local.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except OSError:
+            pass
+
+def call(op, payload=None):
+    """
+    Sends one request to the model server and returns its result.
+
+    A broken connection (e.g. the server restarted) is reopened and the request
+    sent once more; every operation is safe to repeat.
+    """
+    for attempt in range(2):
+        try:
+            conn = _connection()
+            conn.send((op, payload))
+            status, result = conn.recv()
+            break
+        except (EOFError, OSError):
+            _drop_connection()
+            if attempt:
+                raise
+    if status == 'error':
+        raise RuntimeError(f"Model server failed on '{op}': {result}")
+    return result
@@ -0,0 +1,165 @@
+"""
+Local inference server shared by the listener processes on one machine.
+
+One process loads the models once and serves `categorize`, `embed` and
+`answer` requests over a Unix socket. Listener processes started with
+MODEL_SERVER_ADDRESS pointing at the socket send their calls here (see
+model_client.py), so adding workers does not add copies of the models.
+Categorize and embed requests that arrive within MODEL_SERVER_BATCH_WAIT_MS of
+each other, from any worker, are run as one model batch. Usage:
+
+    MODEL_SERVER_ADDRESS=/tmp/email-agent-models.sock python model_server.py
+"""
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from multiprocessing.connection import Listener
+import llm_service
+import model_client
+
+# How long the first request of a batch waits for others to join it
+MODEL_SERVER_BATCH_WAIT_MS = float(os.getenv("MODEL_SERVER_BATCH_WAIT_MS", "10"))
+# How often the server checks the knowledge base files for changes
+KB_REFRESH_SECONDS = 60
+
+class _Coalescer:
+    """Merges concurrent requests for a batch function into shared calls."""
+
+    def __init__(self, name, fn, max_items, wait):
+        self._fn = fn
+        self._max_items = max_items
+        self._wait = wait
+        self._requests = queue.Queue()
+        threading.Thread(target=self._loop, name=f'{name}-batcher', daemon=True).start()
+
+    def submit(self, items):
+        """Queues a list of inputs and returns a Future for the list of their results."""
+        future = Future()
+        self._requests.put((items, future))
+        return future
+
+    def _loop(self):
+        while True:
+            requests = [self._requests.get()]
+            count = len(requests[0][0])
+            deadline = time.monotonic() + self._wait
+            while count < self._max_items:
+                try:
+                    request = self._requests.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                requests.append(request)
+                count += len(request[0])
+
+            try:
+                results = self._fn([item for items, _ in requests for item in items])
+            except Exception as error:
+                for _, future in requests:
+                    future.set_exception(error)
+                continue
+            start = 0
+            for items, future in requests:
+                future.set_result(results[start:start + len(items)])
+                start += len(items)
+
+class ModelServer:
+    def __init__(self, address, authkey=None, batch_wait=MODEL_SERVER_BATCH_WAIT_MS / 1000):
+        self.address = address
+        self.authkey = authkey
+        self.ready = threading.Event()
+        self._listener = None
+        self._closing = False
+        self._categorize = _Coalescer(
+            'categorize', llm_service.categorize_emails, llm_service.CATEGORIZER_BATCH_SIZE, batch_wait
+        )
+        self._embed = _Coalescer('embed', llm_service.embed_texts, 64, batch_wait)
+
+    def _warm_up(self):
+        llm_service.warm_up()
+        self.ready.set()
+        while True:
+            time.sleep(KB_REFRESH_SECONDS)
+            try:
+                llm_service.refresh_knowledge_base()
+            except Exception:
+                logging.error(traceback.format_exc())
+
+    def _handle(self, op, payload):
+        if op == 'categorize':
+            return self._categorize.submit(payload).result()
+        if op == 'embed':
+            return self._embed.submit(payload).result()
+        if op == 'answer':
+            question, embedding = payload
+            return llm_service.get_rag_answer(question, embedding)
+        if op == 'ready':
+            return self.ready.is_set()
+        raise ValueError(f"unknown operation '{op}'")
+
+    def _serve_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    op, payload = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    response = ('ok', self._handle(op, payload))
+                except Exception as error:
+                    logging.error(f"Request '{op}' failed:")
+                    logging.error(traceback.format_exc())
+                    response = ('error', str(error))
+                try:
+                    conn.send(response)
+                except OSError:
+                    return
+
+    def serve_forever(self):
+        """Warms up the models in the background and accepts connections until `close` is called."""
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self._listener = Listener(self.address, family='AF_UNIX', authkey=self.authkey)
+        os.chmod(self.address, 0o600)
+        threading.Thread(target=self._warm_up, name='warmup', daemon=True).start()
+        logging.info(f"Model server listening on {self.address}.")
+
+        while True:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closing:
+                    return
+                # e.g. a client with the wrong authkey or one that hung up during the handshake
+                logging.warning(traceback.format_exc())
+                continue
+            threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self._closing = True
+        if self._listener is not None:
+            self._listener.close()
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s')
+    if not model_client.MODEL_SERVER_ADDRESS:
+        raise SystemExit("Set MODEL_SERVER_ADDRESS to the Unix socket path to serve on.")
+
+    address = model_client.MODEL_SERVER_ADDRESS
+    # The server itself must load the models, not forward to another server
+    model_client.MODEL_SERVER_ADDRESS = None
+    server = ModelServer(address, model_client.get_authkey())
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.close())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Compares an optimized inference backend against the fp32 PyTorch baseline.
+
+Runs the same emails through both versions of each model and reports how often
+the categories agree, how much the QA answers overlap (token F1) and how close
+the embeddings are. Usage:
+
+    python parity_check.py --backend int8 [--samples emails.jsonl] [--output parity.json]
+
+`--samples` is a JSON-lines file with a "body" field per line; by default the
+knowledge base questions and a few built-in emails are used.
+"""
+import argparse
+import json
+import re
+import tempfile
+import time
+from collections import Counter
+import numpy as np
+import kb_index
+import llm_service
+
+DEFAULT_SAMPLES = [
+    "Hi, I would like a refund for my order ORD12345, the item arrived broken.",
+    "Please refund order id: ORD67890. I was charged twice.",
+    "Can you tell me how long shipping to Canada usually takes?",
+    "Do you offer gift cards?",
+    "Your newsletter is great, keep it up!",
+    "URGENT: I have a complaint about the rude delivery driver.",
+    "Unsubscribe me from this list.",
+    "I have a suggestion for your mobile app: add a dark mode."
+]
+
+def _load_samples(path):
+    if path:
+        with open(path, 'r') as f:
+            return [json.loads(line)['body'] for line in f if line.strip()]
+    return DEFAULT_SAMPLES + [entry['question'] for entry in kb_index.load_entries()]
+
+def _tokens(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+def _token_f1(a, b):
+    """SQuAD-style token overlap between two answers; 1.0 when both are empty."""
+    tokens_a, tokens_b = _tokens(a), _tokens(b)
+    if not tokens_a or not tokens_b:
+        return float(tokens_a == tokens_b)
+    common = sum((Counter(tokens_a) & Counter(tokens_b)).values())
+    if common == 0:
+        return 0.0
+    precision, recall = common / len(tokens_a), common / len(tokens_b)
+    return 2 * precision * recall / (precision + recall)
+
+def _categorize(categorizer, texts):
+    start = time.perf_counter()
+    results = categorizer([text[:512] for text in texts], llm_service.CANDIDATE_LABELS)
+    elapsed = time.perf_counter() - start
+    if isinstance(results, dict):
+        results = [results]
+    return [llm_service._label_to_category(result['labels'][0]) for result in results], elapsed
+
+def _answer(qa, questions, contexts):
+    start = time.perf_counter()
+    answers = []
+    for question, context in zip(questions, contexts):
+        result = qa(question=question[:1000], context=context)
+        answers.append(result['answer'] if result['score'] > 0.3 else None)
+    return answers, time.perf_counter() - start
+
+def run(backend, samples):
+    print(f"Comparing '{backend}' against the fp32 baseline on {len(samples)} samples...")
+
+    base_embeddings = llm_service.load_embeddings("torch")
+    test_embeddings = llm_service.load_embeddings(backend)
+    base_vectors = np.array(base_embeddings.embed_documents(samples), dtype='float32')
+    test_vectors = np.array(test_embeddings.embed_documents(samples), dtype='float32')
+    cosines = np.sum(base_vectors * test_vectors, axis=1) / (
+        np.linalg.norm(base_vectors, axis=1) * np.linalg.norm(test_vectors, axis=1)
+    )
+
+    base_labels, base_cat_time = _categorize(llm_service.load_categorizer("torch"), samples)
+    test_labels, test_cat_time = _categorize(llm_service.load_categorizer(backend), samples)
+    agreement = sum(a == b for a, b in zip(base_labels, test_labels)) / len(samples)
+
+    # Both QA models get the same baseline context so only the QA step is compared.
+    # A throwaway index keeps the listener's index untouched.
+    vector_store, _ = kb_index.load_vector_store(base_embeddings, index_dir=tempfile.mkdtemp())
+    contexts = [
+        " ".join(doc.page_content for doc in vector_store.similarity_search_by_vector(vector.tolist()))
+        for vector in base_vectors
+    ]
+    base_answers, base_qa_time = _answer(llm_service.load_qa("torch"), samples, contexts)
+    test_answers, test_qa_time = _answer(llm_service.load_qa(backend), samples, contexts)
+    overlaps = [_token_f1(a, b) for a, b in zip(base_answers, test_answers)]
+
+    report = {
+        'backend': backend,
+        'samples': len(samples),
+        'label_agreement': agreement,
+        'answer_token_f1': float(np.mean(overlaps)),
+        'answer_exact_match': sum(a == b for a, b in zip(base_answers, test_answers)) / len(samples),
+        'embedding_cosine_mean': float(np.mean(cosines)),
+        'embedding_cosine_min': float(np.min(cosines)),
+        'categorize_seconds': {'torch': base_cat_time, backend: test_cat_time},
+        'qa_seconds': {'torch': base_qa_time, backend: test_qa_time},
+        'label_mismatches': [
+            {'body': sample[:200], 'torch': a, backend: b}
+            for sample, a, b in zip(samples, base_labels, test_labels) if a != b
+        ]
+    }
+    print(f"  Label agreement:     {report['label_agreement']:.1%}")
+    print(f"  Answer token F1:     {report['answer_token_f1']:.3f} (exact match {report['answer_exact_match']:.1%})")
+    print(f"  Embedding cosine:    mean {report['embedding_cosine_mean']:.4f}, min {report['embedding_cosine_min']:.4f}")
+    print(f"  Categorize time (s): torch {base_cat_time:.2f}, {backend} {test_cat_time:.2f}")
+    print(f"  QA time (s):         torch {base_qa_time:.2f}, {backend} {test_qa_time:.2f}")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Check an inference backend against the fp32 baseline.")
+    parser.add_argument('--backend', choices=[b for b in llm_service.BACKENDS if b != "torch"], default="int8")
+    parser.add_argument('--samples', help="JSON-lines file with a 'body' field per line")
+    parser.add_argument('--output', help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = run(args.backend, _load_samples(args.samples))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
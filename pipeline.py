@@ -0,0 +1,299 @@
+"""
+Staged producer/consumer pipeline used by the listener.
+
+    accounts -> fetchers -> classify queue -> inference -> handle queue -> handlers
+                                                                  -> finish queue -> finishers
+
+Fetcher threads poll Gmail and clean bodies, a single inference thread drops
+duplicates (see dedup) and categorizes whatever has queued up in one batch
+(across accounts), and handler threads run the category handlers and send
+replies. The queues are bounded, so
+fetchers stop when inference falls behind. Once all of an account's emails are
+through, a finisher thread waits for the rows they buffered to be committed,
+marks them as read and saves the account's sync cursor; that I/O never runs
+on the inference thread.
+"""
+import logging
+import queue
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+import dedup
+import gmail_async
+import gmail_service
+import llm_service
+import preclassifier
+import processing_service
+from metrics import EMAILS_PROCESSED, EMAIL_ERRORS
+
+_STOP = object()
+
+def _with_collapsed(email):
+    """The email and the earlier messages of its thread that dedup folded into it."""
+    return [email] + email.get('collapsed', [])
+
+class _AccountBatch:
+    """Tracks the emails fetched for one account in one poll until all are handled."""
+
+    def __init__(self, account, service, history_id, size):
+        self.account = account
+        self.service = service
+        self.history_id = history_id
+        self.size = size
+        self.remaining = size
+        self.handled = []
+        self.failed = [] # (email, error)
+        # googleapiclient services are not thread-safe, so one account's emails are handled one at a time;
+        # async sessions are, and their requests go out concurrently
+        self.service_lock = nullcontext() if isinstance(service, gmail_async.GmailSession) else threading.Lock()
+
+class EmailPipeline:
+    def __init__(self, poll_account, save_history_id, fetchers=4, handlers=4, finishers=2,
+                 batch_size=None, queue_size=256, batch_wait=0.05, email_done=None, account_done=None):
+        """
+        `poll_account(account)` returns (pending, history_id) as in run_listener;
+        `save_history_id(account, history_id, failed)` is called once an
+        account's emails have all been handled. The optional
+        `email_done(account, email, error)` is called for each email once its
+        rows are committed (error None) or when it failed (error is a message).
+        The optional `account_done(account, emails, error)` is called when an
+        account leaves the pipeline, with the number of emails its poll found,
+        and the error if the poll failed.
+        """
+        self._poll_account = poll_account
+        self._save_history_id = save_history_id
+        self._email_done = email_done
+        self._account_done = account_done
+        self._fetchers = fetchers
+        self._handlers = handlers
+        self._finishers = finishers
+        self._batch_size = batch_size or llm_service.CATEGORIZER_BATCH_SIZE
+        self._batch_wait = batch_wait
+        self._account_queue = queue.Queue()
+        self._classify_queue = queue.Queue(maxsize=queue_size)
+        self._handle_queue = queue.Queue(maxsize=queue_size)
+        # Unbounded: a full queue would block the inference thread, which it must never do
+        self._finish_queue = queue.Queue()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._threads = {'fetch': [], 'inference': [], 'handle': [], 'finish': []}
+        self._stopping = False
+
+    def start(self):
+        for i in range(self._fetchers):
+            self._spawn('fetch', self._fetch_loop, f'fetch-{i}')
+        self._spawn('inference', self._inference_loop, 'inference-stage')
+        for i in range(self._handlers):
+            self._spawn('handle', self._handle_loop, f'handle-{i}')
+        for i in range(self._finishers):
+            self._spawn('finish', self._finish_loop, f'finish-{i}')
+
+    def _spawn(self, stage, target, name):
+        thread = threading.Thread(target=target, name=name, daemon=True)
+        thread.start()
+        self._threads[stage].append(thread)
+
+    def submit_account(self, account):
+        """
+        Queues an account for polling. Returns False if the account is still in
+        the pipeline from an earlier cycle, so a backlog never piles up.
+        """
+        with self._lock:
+            if self._stopping or account['user_email'] in self._in_flight:
+                return False
+            self._in_flight.add(account['user_email'])
+        self._account_queue.put(account)
+        return True
+
+    def _release(self, account, emails=0, error=None):
+        with self._lock:
+            self._in_flight.discard(account['user_email'])
+        if self._account_done:
+            try:
+                self._account_done(account, emails, error)
+            except Exception:
+                logging.error(f"Could not record the poll of account {account['user_email']}:")
+                logging.error(traceback.format_exc())
+
+    def _fetch_loop(self):
+        while True:
+            account = self._account_queue.get()
+            if account is _STOP:
+                return
+            try:
+                pending, history_id = self._poll_account(account)
+            except Exception:
+                EMAIL_ERRORS.inc(account=account['user_email'], stage='poll')
+                logging.error(f"An error occurred while polling account {account['user_email']}:")
+                logging.error(traceback.format_exc())
+                self._release(account, error=traceback.format_exc(limit=1))
+                continue
+
+            if not pending:
+                self._finish_queue.put(_AccountBatch(account, None, history_id, 0))
+                continue
+            batch = _AccountBatch(account, pending[0][0], history_id, len(pending))
+            for _, _, email in pending:
+                # Blocks while the queue is full, which holds back further fetching
+                self._classify_queue.put((batch, email))
+
+    def _inference_loop(self):
+        while True:
+            item = self._classify_queue.get()
+            if item is _STOP:
+                self._stop_handlers()
+                return
+
+            # Gather whatever else arrives shortly after, up to one batch
+            items = [item]
+            stop_after = False
+            deadline = time.monotonic() + self._batch_wait
+            while len(items) < self._batch_size:
+                try:
+                    item = self._classify_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop_after = True
+                    break
+                items.append(item)
+
+            # Oversized and attachment-only emails go to a person without inference
+            for batch, email in items:
+                if email.get('skip_reason'):
+                    self._handle_queue.put((batch, email, processing_service.SKIPPED))
+            items = [item for item in items if not item[1].get('skip_reason')]
+
+            try:
+                # Repeats and same-thread follow-ups count as handled without a reply
+                suppressed = dedup.find_duplicates([(batch.account['user_email'], email) for batch, email in items])
+                for i in suppressed:
+                    # Folded messages are finished with the email that carries their text
+                    if not items[i][1].get('collapsed_into'):
+                        self._done(*items[i])
+                items = [item for i, item in enumerate(items) if i not in suppressed]
+                emails = [email for _, email in items]
+                processing_service.attach_features(emails)
+                categories = preclassifier.categorize(emails)
+            except Exception:
+                logging.error(f"Categorization failed for a batch of {len(items)} email(s):")
+                logging.error(traceback.format_exc())
+                error = traceback.format_exc(limit=1)
+                for batch, email in items:
+                    if email.get('collapsed_into'):
+                        continue
+                    EMAIL_ERRORS.inc(account=batch.account['user_email'], stage='categorize')
+                    self._done(batch, email, error=error)
+            else:
+                for (batch, email), category in zip(items, categories):
+                    self._handle_queue.put((batch, email, category))
+
+            if stop_after:
+                self._stop_handlers()
+                return
+
+    def _stop_handlers(self):
+        for _ in self._threads['handle']:
+            self._handle_queue.put(_STOP)
+
+    def _handle_loop(self):
+        while True:
+            item = self._handle_queue.get()
+            if item is _STOP:
+                return
+            batch, email, category = item
+            account_email = batch.account['user_email']
+            try:
+                with batch.service_lock:
+                    processing_service.dispatch_email(batch.service, email, category)
+                EMAILS_PROCESSED.inc(account=account_email, category=category)
+                self._done(batch, email)
+            except Exception:
+                EMAIL_ERRORS.inc(account=account_email, stage='handle')
+                logging.error(f"Failed to handle email {email['id']} for account {account_email}:")
+                logging.error(traceback.format_exc())
+                self._done(batch, email, error=traceback.format_exc(limit=1))
+
+    def _done(self, batch, email, error=None):
+        with self._lock:
+            if error is None:
+                batch.handled.append(email)
+            else:
+                batch.failed.append((email, error))
+            batch.remaining -= len(_with_collapsed(email))
+            finished = batch.remaining == 0
+        if finished:
+            self._finish_queue.put(batch)
+
+    def _finish_loop(self):
+        while True:
+            batch = self._finish_queue.get()
+            if batch is _STOP:
+                return
+            self._finish(batch)
+
+    def _record_outcome(self, batch, email, error):
+        if not self._email_done:
+            return
+        try:
+            self._email_done(batch.account, email, error)
+        except Exception:
+            logging.error(f"Could not record the outcome of email {email['id']}:")
+            logging.error(traceback.format_exc())
+
+    def _finish(self, batch):
+        """
+        Waits until the rows the handlers buffered for an account are committed,
+        then marks its handled emails as read and advances its cursor.
+        """
+        account_email = batch.account['user_email']
+        error = None
+        try:
+            write_failures = processing_service.wait_for_writes(batch.handled)
+            handled = []
+            for email in batch.handled:
+                if email['id'] in write_failures:
+                    EMAIL_ERRORS.inc(account=account_email, stage='db')
+                    batch.failed.append((email, str(write_failures[email['id']])))
+                else:
+                    handled.extend(_with_collapsed(email))
+            # Folded messages stay unread with a failed email, so their text is there on the retry
+            failed = [(folded, error) for email, error in batch.failed for folded in _with_collapsed(email)]
+            for email in handled:
+                self._record_outcome(batch, email, None)
+            for email, error in failed:
+                self._record_outcome(batch, email, error)
+
+            if handled:
+                with batch.service_lock:
+                    gmail_service.mark_as_read_batch(batch.service, [email['id'] for email in handled])
+            self._save_history_id(batch.account, batch.history_id, [email for email, _ in failed])
+        except Exception:
+            EMAIL_ERRORS.inc(account=account_email, stage='mark_read')
+            logging.error(f"Could not finish processing for account {account_email}:")
+            logging.error(traceback.format_exc())
+            error = traceback.format_exc(limit=1)
+        finally:
+            self._release(batch.account, batch.size, error)
+
+    def shutdown(self):
+        """
+        Stops accepting accounts and drains every queue: fetchers finish their
+        current account, and everything already fetched is categorized, handled
+        and marked as read before this returns.
+        """
+        with self._lock:
+            self._stopping = True
+        for _ in self._threads['fetch']:
+            self._account_queue.put(_STOP)
+        for thread in self._threads['fetch']:
+            thread.join()
+        self._classify_queue.put(_STOP)
+        for thread in self._threads['inference'] + self._threads['handle']:
+            thread.join()
+        for _ in self._threads['finish']:
+            self._finish_queue.put(_STOP)
+        for thread in self._threads['finish']:
+            thread.join()
+        processing_service.writes.flush()
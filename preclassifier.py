@@ -0,0 +1,224 @@
+"""
+Tiered email categorization in front of the zero-shot model.
+
+1. Rules catch the obvious cases: an order id plus the word "refund" is a
+   Refund; mailing lists, auto-replies and no-reply senders are Other.
+2. An optional logistic regression on MiniLM embeddings, trained from logged
+   BART decisions, takes emails it is at least PRECLASSIFIER_THRESHOLD sure about.
+3. Everything else is escalated to BART (`llm_service.categorize_emails`).
+
+With PRECLASSIFIER_LOG set, BART's decisions are appended to it as training
+data; the file is rotated at PRECLASSIFIER_LOG_MAX_BYTES. A sample of the
+fast-path decisions is also sent to BART, to measure agreement. Train or
+retrain the model with:
+
+    python preclassifier.py train [--log classifier_decisions.jsonl] [--output preclassifier.npz]
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import List
+import numpy as np
+import llm_service
+from metrics import Counter
+
+# 'off' (always BART), 'rules' or 'model' (rules, then the trained model)
+PRECLASSIFIER = os.getenv("PRECLASSIFIER", "rules")
+PRECLASSIFIER_MODEL = os.getenv("PRECLASSIFIER_MODEL", "preclassifier.npz")
+# Minimum predicted probability for the model to decide without BART
+PRECLASSIFIER_THRESHOLD = float(os.getenv("PRECLASSIFIER_THRESHOLD", "0.9"))
+# BART decisions, with the start of each email, are logged here as training data; off when empty
+PRECLASSIFIER_LOG = os.getenv("PRECLASSIFIER_LOG", "")
+# The log is moved to <log>.1 (replacing the previous one) once it grows past this size
+PRECLASSIFIER_LOG_MAX_BYTES = int(os.getenv("PRECLASSIFIER_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+DEFAULT_LOG = "classifier_decisions.jsonl"
+# The model reads the embedding of an email's question sentences, like the live features
+FEATURE_INPUT = "question"
+# Fraction of fast-path decisions double-checked by BART
+PRECLASSIFIER_SHADOW_RATE = float(os.getenv("PRECLASSIFIER_SHADOW_RATE", "0.05"))
+
+CATEGORIES = ["Question", "Refund", "Other"]
+
+_ORDER_ID = re.compile(r'\bORD\d+\b', re.IGNORECASE)
+_REFUND = re.compile(r'\brefund', re.IGNORECASE)
+_NO_REPLY_SENDER = re.compile(r'\b(?:no-?reply|do-?not-?reply|mailer-daemon|postmaster)@', re.IGNORECASE)
+_AUTO_REPLY_SUBJECT = re.compile(r'^(?:auto(?:matic)?[ -]?reply|out of (?:the )?office)\b', re.IGNORECASE)
+
+DECISIONS = Counter('preclassifier_decisions_total', 'Categorization decisions by tier (rules, model or bart).')
+SHADOW_CHECKS = Counter('preclassifier_shadow_checks_total', 'Fast-path decisions re-checked by BART, by agreement.')
+
+_model = None
+_model_loaded = False
+_model_lock = threading.Lock()
+_log_lock = threading.Lock()
+
+def classify_by_rules(email):
+    """Returns (category, rule) for obvious emails, or None."""
+    if email.get('list_unsubscribe'):
+        return "Other", "list-unsubscribe"
+    if (email.get('auto_submitted') or 'no').lower() != 'no':
+        return "Other", "auto-submitted"
+    if (email.get('precedence') or '').lower() in ('bulk', 'list', 'junk'):
+        return "Other", "precedence"
+    if _NO_REPLY_SENDER.search(email.get('from') or ''):
+        return "Other", "no-reply-sender"
+    if _AUTO_REPLY_SUBJECT.search(email.get('subject') or ''):
+        return "Other", "auto-reply-subject"
+    body = email['clean_body']
+    if _ORDER_ID.search(body) and _REFUND.search(body):
+        return "Refund", "order-id-and-refund"
+    return None
+
+def _features(vectors):
+    vectors = np.asarray(vectors, dtype='float32')
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def _load_model():
+    """Loads the trained model once; None if there is none or it was trained on other embeddings."""
+    global _model, _model_loaded
+    if _model_loaded:
+        return _model
+    with _model_lock:
+        if not _model_loaded:
+            if os.path.exists(PRECLASSIFIER_MODEL):
+                data = np.load(PRECLASSIFIER_MODEL)
+                feature_input = str(data['feature_input']) if 'feature_input' in data else 'body'
+                if str(data['embedding_model']) == llm_service.embedding_model_id() and feature_input == FEATURE_INPUT:
+                    _model = {'weights': data['weights'], 'bias': data['bias'], 'labels': [str(label) for label in data['labels']]}
+                else:
+                    logging.warning(f"{PRECLASSIFIER_MODEL} was trained on different embeddings or inputs; retrain it. Using rules only.")
+            else:
+                logging.warning(f"No pre-classifier model at {PRECLASSIFIER_MODEL}; using rules only.")
+            _model_loaded = True
+    return _model
+
+def _log_decisions(emails, categories):
+    if not PRECLASSIFIER_LOG or not emails:
+        return
+    with _log_lock:
+        _rotate_log()
+        with open(PRECLASSIFIER_LOG, 'a') as f:
+            for email, category in zip(emails, categories):
+                # Long enough to cover the embedding model's input window, like the live features
+                f.write(json.dumps({'text': email['clean_body'][:2000], 'label': category, 'at': int(time.time())}) + '\n')
+
+def _rotate_log():
+    # At most two files of customer text are kept, so the log cannot fill the disk
+    try:
+        if os.path.getsize(PRECLASSIFIER_LOG) >= PRECLASSIFIER_LOG_MAX_BYTES:
+            os.replace(PRECLASSIFIER_LOG, PRECLASSIFIER_LOG + '.1')
+    except FileNotFoundError:
+        pass
+
+def categorize(emails) -> List[str]:
+    """
+    Categorizes emails (dicts with 'clean_body' and headers) in input order,
+    sending to BART only the ones the cheaper tiers are not sure about.
+    """
+    if not emails:
+        return []
+    if PRECLASSIFIER == 'off':
+        return llm_service.categorize_emails([email['clean_body'] for email in emails])
+
+    categories = [None] * len(emails)
+    tiers = [None] * len(emails)
+    for i, email in enumerate(emails):
+        decision = classify_by_rules(email)
+        if decision:
+            categories[i], tiers[i] = decision[0], 'rules'
+
+    model = _load_model() if PRECLASSIFIER == 'model' else None
+    undecided = [i for i in range(len(emails)) if categories[i] is None]
+    if model and undecided:
+        missing = [i for i in undecided if 'features' not in emails[i]]
+        embedded = dict(zip(missing, llm_service.embed_texts(
+            [llm_service.extract_question(emails[i]['clean_body']) for i in missing]
+        )))
+        vectors = [emails[i]['features']['embedding'] if 'features' in emails[i] else embedded[i] for i in undecided]
+        probabilities = _softmax(_features(vectors) @ model['weights'] + model['bias'])
+        for i, row in zip(undecided, probabilities):
+            if row.max() >= PRECLASSIFIER_THRESHOLD:
+                categories[i], tiers[i] = model['labels'][int(row.argmax())], 'model'
+
+    fast = [i for i in range(len(emails)) if categories[i] is not None]
+    shadow = [i for i in fast if random.random() < PRECLASSIFIER_SHADOW_RATE]
+    escalated = [i for i in range(len(emails)) if categories[i] is None]
+    checked = escalated + shadow
+    if checked:
+        bart = llm_service.categorize_emails([emails[i]['clean_body'] for i in checked])
+        for i, category in zip(checked, bart):
+            if categories[i] is None:
+                categories[i], tiers[i] = category, 'bart'
+            else:
+                agree = categories[i] == category
+                SHADOW_CHECKS.inc(tier=tiers[i], agree=str(agree).lower())
+                if not agree:
+                    logging.info(f"Pre-classifier ({tiers[i]}) said {categories[i]} but BART said {category} for email {emails[i]['id']}.")
+        _log_decisions([emails[i] for i in checked], bart)
+
+    for tier in tiers:
+        DECISIONS.inc(tier=tier)
+    logging.info(f"Categorized {len(emails)} email(s): {len(fast)} by the pre-classifier, {len(escalated)} escalated to BART.")
+    return categories
+
+# --- Training ---
+
+def train(log_path=PRECLASSIFIER_LOG or DEFAULT_LOG, output=PRECLASSIFIER_MODEL, epochs=300, learning_rate=0.5, l2=1e-4, seed=42):
+    """Fits a softmax regression on embeddings of the logged decisions and saves it."""
+    with open(log_path, 'r') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # The latest decision wins for repeated texts
+    latest = {record['text']: record['label'] for record in records if record['label'] in CATEGORIES}
+    texts, labels = list(latest), [CATEGORIES.index(label) for label in latest.values()]
+    if len(texts) < 20:
+        raise SystemExit(f"Only {len(texts)} distinct logged decisions in {log_path}; collect more before training.")
+
+    print(f"Embedding {len(texts)} logged emails...")
+    features = _features(llm_service.embed_texts([llm_service.extract_question(text) for text in texts]))
+    targets = np.eye(len(CATEGORIES), dtype='float32')[labels]
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(texts))
+    split = max(1, len(texts) // 5)
+    test, fit = order[:split], order[split:]
+
+    weights = np.zeros((features.shape[1], len(CATEGORIES)), dtype='float32')
+    bias = np.zeros(len(CATEGORIES), dtype='float32')
+    for _ in range(epochs):
+        error = _softmax(features[fit] @ weights + bias) - targets[fit]
+        weights -= learning_rate * (features[fit].T @ error / len(fit) + l2 * weights)
+        bias -= learning_rate * error.mean(axis=0)
+
+    probabilities = _softmax(features[test] @ weights + bias)
+    predicted = probabilities.argmax(axis=1)
+    actual = np.asarray(labels)[test]
+    confident = probabilities.max(axis=1) >= PRECLASSIFIER_THRESHOLD
+    print(f"Held-out accuracy: {np.mean(predicted == actual):.1%} on {len(test)} emails")
+    if confident.any():
+        print(f"At threshold {PRECLASSIFIER_THRESHOLD}: {confident.mean():.1%} handled without BART, "
+              f"{np.mean(predicted[confident] == actual[confident]):.1%} of them correct")
+    else:
+        print(f"At threshold {PRECLASSIFIER_THRESHOLD}: no held-out email would skip BART")
+
+    np.savez(output, weights=weights, bias=bias, labels=np.array(CATEGORIES),
+             embedding_model=np.array(llm_service.embedding_model_id()), feature_input=np.array(FEATURE_INPUT))
+    print(f"Saved pre-classifier to {output}.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the pre-classifier from logged BART decisions.")
+    parser.add_argument('command', choices=["train"])
+    parser.add_argument('--log', default=PRECLASSIFIER_LOG or DEFAULT_LOG)
+    parser.add_argument('--output', default=PRECLASSIFIER_MODEL)
+    args = parser.parse_args()
+    train(args.log, args.output)
@@ -1,14 +1,80 @@
 import re
 import llm_service
 import gmail_service
-from database import get_db_connection
+import dedup
+import preclassifier
+import write_buffer
+from database import pooled_connection
+from metrics import EMAILS_PROCESSED, STAGE_SECONDS
 import logging
 
+UNHANDLED_COLUMNS = ('received_from', 'subject', 'body', 'category', 'importance')
+# Category of emails too large or without text to process (see gmail_service), which skip the models
+SKIPPED = "Skipped"
+_SKIP_NOTES = {
+    'oversized': "Not processed automatically: the message text is too large.",
+    'attachment_only': "Not processed automatically: the message has only attachments."
+}
+
+# Rows the handlers log are written in batches; see write_buffer
+writes = write_buffer.WriteBuffer()
+
+def _buffer_insert(email, table, columns, row):
+    """Queues a row for `table`, tied to the email so it can be waited for before marking it read."""
+    email.setdefault('pending_writes', []).append(writes.add(table, columns, row))
+
+def wait_for_writes(emails):
+    """
+    Commits the rows buffered for these emails, and waits for them.
+
+    Returns {email id: error} for emails whose rows could not be written;
+    those must not be marked as read.
+    """
+    if any(email.get('pending_writes') for email in emails):
+        writes.flush()
+    failures = {}
+    for email in emails:
+        error = write_buffer.wait_for(email.pop('pending_writes', []))
+        if error is not None:
+            failures[email['id']] = error
+    return failures
+
+def clean_body(email):
+    """Returns the email's cleaned body, cleaning it on first use and caching it on the email."""
+    if 'clean_body' not in email:
+        email['clean_body'] = gmail_service.clean_email_body(email['body'], email.get('body_type') == 'text/html')
+    return email['clean_body']
+
+def attach_features(emails):
+    """
+    Computes each email's features once, with one embedding batch for all of them.
+
+    email['features'] holds the cleaned body, the sentences that ask something
+    (see llm_service.extract_question) and their MiniLM embedding. The
+    pre-classifier, the answer cache and retrieval all read from it instead of
+    re-encoding the text.
+    """
+    missing = [email for email in emails if 'features' not in email]
+    if not missing:
+        return
+    bodies = [clean_body(email) for email in missing]
+    questions = [llm_service.extract_question(body) for body in bodies]
+    vectors = llm_service.embed_texts(questions)
+    for email, body, question, vector in zip(missing, bodies, questions, vectors):
+        email['features'] = {
+            'clean_body': body,
+            'question': question,
+            'embedding': vector
+        }
+
 def handle_question(service, email):
     """Handles emails categorized as 'Question' using RAG."""
     logging.info(f"Handling QUESTION from {email['from']}")
-    question = gmail_service.clean_email_body(email['body'])
-    answer = llm_service.get_rag_answer(question)
+    features = email.get('features')
+    if features:
+        answer = llm_service.get_rag_answer(features['question'], features['embedding'])
+    else:
+        answer = llm_service.get_rag_answer(clean_body(email))
     
     if answer:
         reply_body = f"Hello,\n\nHere is an answer to your question:\n\n\"{answer}\"\n\nIf this doesn't help, please let us know.\n\nThank you,\nSupport Agent"
@@ -16,98 +82,113 @@ def handle_question(service, email):
     else:
         # Save as unhandled with high importance
         logging.warning(f"Could not find an answer for email from {email['from']}. Saving to unhandled.")
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO unhandled_emails (received_from, subject, body, category, importance)
-            VALUES (%s, %s, %s, %s, %s)
-            """,
+        _buffer_insert(
+            email, 'unhandled_emails', UNHANDLED_COLUMNS,
             (email['from'], email['subject'], email['body'], 'Question', 5)
         )
-        conn.commit()
-        cur.close()
-        conn.close()
 
 def handle_refund(service, email):
     """Handles emails categorized as 'Refund' with database logic."""
     logging.info(f"Handling REFUND from {email['from']}")
     customer_email_match = re.search(r'<(.+?)>', email['from'])
     customer_email = customer_email_match.group(1) if customer_email_match else email['from']
-    body = gmail_service.clean_email_body(email['body'])
+    body = clean_body(email)
     
     match = re.search(r'order id\s*[:\s-]*([A-Z0-9]+)', body, re.IGNORECASE)
     if not match:
         match = re.search(r'\b(ORD\d+)\b', body, re.IGNORECASE)
 
-    conn = get_db_connection()
-    cur = conn.cursor()
-
+    reply_body = None
     if not match:
         reply_body = "Hello,\n\nWe've received your refund request but could not find an order ID. Please reply to this email with your order ID.\n\nThank you,\nSupport Agent"
-        gmail_service.send_reply(service, email['from'], f"Re: {email['subject']}", reply_body, email['threadId'])
     else:
         order_id = match.group(1).upper()
-        cur.execute("SELECT * FROM orders WHERE order_id = %s", (order_id,))
-        order = cur.fetchone()
-
-        if order:
-            cur.execute("UPDATE orders SET status = 'refund_requested' WHERE order_id = %s", (order_id,))
-            conn.commit()
-            reply_body = f"Hello,\n\nYour refund request for order {order_id} has been received. It will be processed within 3 business days.\n\nThank you,\nSupport Agent"
-            gmail_service.send_reply(service, email['from'], f"Re: {email['subject']}", reply_body, email['threadId'])
-        else:
-            if email.get('in_reply_to'):
-                cur.execute(
-                    """
-                    INSERT INTO not_found_refund_requests (customer_email, invalid_order_id_attempted, full_email_body)
-                    VALUES (%s, %s, %s)
-                    """,
+        # The transaction is committed before the reply goes out
+        with STAGE_SECONDS.time(stage='db', category='Refund'), pooled_connection() as conn, conn.cursor() as cur:
+            cur.execute("SELECT * FROM orders WHERE order_id = %s", (order_id,))
+            order = cur.fetchone()
+
+            if order:
+                cur.execute("UPDATE orders SET status = 'refund_requested' WHERE order_id = %s", (order_id,))
+                reply_body = f"Hello,\n\nYour refund request for order {order_id} has been received. It will be processed within 3 business days.\n\nThank you,\nSupport Agent"
+            elif email.get('in_reply_to'):
+                _buffer_insert(
+                    email, 'not_found_refund_requests',
+                    ('customer_email', 'invalid_order_id_attempted', 'full_email_body'),
                     (customer_email, order_id, email['body'])
                 )
-                conn.commit()
                 logging.warning(f"Logged repeated invalid order ID attempt from {customer_email} for ID '{order_id}'.") # <-- CORRECTED
             else:
                 reply_body = f"Hello,\n\nWe could not find an order with the ID '{order_id}'. Please double-check the ID and reply to this email.\n\nThank you,\nSupport Agent"
-                gmail_service.send_reply(service, email['from'], f"Re: {email['subject']}", reply_body, email['threadId'])
-    
-    cur.close()
-    conn.close()
+
+    if reply_body:
+        gmail_service.send_reply(service, email['from'], f"Re: {email['subject']}", reply_body, email['threadId'])
 
 def handle_other(service, email):
     """Handles all other emails by assessing importance and saving."""
     logging.info(f"Handling OTHER from {email['from']}") 
-    importance = llm_service.assess_importance(email['body'])
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO unhandled_emails (received_from, subject, body, category, importance)
-        VALUES (%s, %s, %s, %s, %s)
-        """,
+    # Scored on the cleaned text, so keywords in quoted history do not count
+    importance = llm_service.assess_importance(clean_body(email))
+    _buffer_insert(
+        email, 'unhandled_emails', UNHANDLED_COLUMNS,
         (email['from'], email['subject'], email['body'], 'Other', importance)
     )
-    conn.commit()
-    cur.close()
-    conn.close()
 
-def process_email(service, account, email_summary):
-    """Main pipeline for processing a single email."""
+def handle_skipped(service, email):
+    """Leaves an email that could not be processed automatically to a person, with its snippet."""
+    logging.info(f"Skipping {email['skip_reason']} email from {email['from']}")
+    body = f"{_SKIP_NOTES.get(email['skip_reason'], email['skip_reason'])}\n\n{email.get('snippet') or ''}"
+    _buffer_insert(
+        email, 'unhandled_emails', UNHANDLED_COLUMNS,
+        (email['from'], email['subject'], body, 'Other', 3)
+    )
+
+def prepare_email(service, email_summary):
+    """Fetches an email and attaches its cleaned body, ready for categorization."""
     email_details = gmail_service.get_email_details(service, email_summary['id'])
-    clean_body = gmail_service.clean_email_body(email_details['body'])
-    category = llm_service.categorize_email(clean_body)
+    clean_body(email_details)
+    return email_details
+
+def prepare_emails(service, email_summaries):
+    """Fetches many emails with batched Gmail requests and attaches their cleaned bodies."""
+    emails = gmail_service.get_email_details_batch(service, [summary['id'] for summary in email_summaries])
+    for email in emails:
+        clean_body(email)
+    return emails
 
+def dispatch_email(service, email, category):
+    """Runs the handler for an already categorized email."""
     logging.info("--- New Email Received ---")
-    logging.info(f"  From: {email_details['from']}")
-    logging.info(f"  Subject: {email_details['subject']}")
+    logging.info(f"  From: {email['from']}")
+    logging.info(f"  Subject: {email['subject']}")
     logging.info(f"  Category: {category}")
     logging.info("--------------------------")
 
-    if category == "Question":
-        handle_question(service, email_details)
-    elif category == "Refund":
-        handle_refund(service, email_details)
+    with STAGE_SECONDS.time(stage='handle', category=category):
+        if category == "Question":
+            handle_question(service, email)
+        elif category == "Refund":
+            handle_refund(service, email)
+        elif category == SKIPPED:
+            handle_skipped(service, email)
+        else:
+            handle_other(service, email)
+
+def process_email(service, account, email_summary):
+    """Main pipeline for processing a single email."""
+    email_details = prepare_email(service, email_summary)
+    if email_details.get('skip_reason'):
+        category = SKIPPED
+    elif dedup.find_duplicates([(account['user_email'], email_details)]):
+        # Already answered recently; nothing to do but mark it as read
+        gmail_service.mark_as_read(service, email_details['id'])
+        return
     else:
-        handle_other(service, email_details)
-        
-    gmail_service.mark_as_read(service, email_details['id'])
\ No newline at end of file
+        attach_features([email_details])
+        category = preclassifier.categorize([email_details])[0]
+    dispatch_email(service, email_details, category)
+    error = wait_for_writes([email_details]).get(email_details['id'])
+    if error is not None:
+        raise error
+    gmail_service.mark_as_read(service, email_details['id'])
+    EMAILS_PROCESSED.inc(account=account['user_email'], category=category)
@@ -1,20 +1,144 @@
 import logging
-import time
 import json
-from database import get_db_connection
+import signal
+import threading
+import time
+from database import pooled_connection
+import gmail_clients
 import gmail_service
+import job_queue
+import llm_service
+import metrics
 import processing_service
-from google.oauth2.credentials import Credentials
+from pipeline import EmailPipeline
+from scheduler import PollScheduler
 import os
 import psycopg2.extras
 import traceback
-from security import encrypt_token_to_str, decrypt_token_from_str
+
+# Threads polling Gmail accounts and threads running handlers / sending replies
+LISTENER_WORKERS = int(os.getenv("LISTENER_WORKERS", "4"))
+PIPELINE_HANDLERS = int(os.getenv("PIPELINE_HANDLERS", "4"))
+# Emails allowed to wait between pipeline stages before fetching is held back
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "256"))
+# 'history' syncs incrementally from the stored Gmail history id, 'full' lists all unread mail every cycle
+GMAIL_SYNC_MODE = os.getenv("GMAIL_SYNC_MODE", "history")
+# Port of the Prometheus /metrics endpoint; 0 disables it
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Share accounts and emails with other listener replicas through the Postgres job queue
+USE_JOB_QUEUE = os.getenv("USE_JOB_QUEUE", "0") == "1"
+# Jobs claimed per account and poll in job queue mode
+JOB_CLAIM_LIMIT = int(os.getenv("JOB_CLAIM_LIMIT", "100"))
+# 'blocking' (googleapiclient) or 'async' (shared asyncio HTTP/2 client, see gmail_async)
+GMAIL_TRANSPORT = os.getenv("GMAIL_TRANSPORT", "blocking")
+# How often the account list, knowledge base and account leases are refreshed; polls follow the scheduler
+ACCOUNT_REFRESH_SECONDS = float(os.getenv("ACCOUNT_REFRESH_SECONDS", "60"))
+
+def poll_account(account, secrets):
+    """
+    Fetches the new unread emails of one account.
+
+    Returns (pending, history_id): the (service, account_email, email) tuples
+    ready for categorization, and the history id to store
+    once they have been handled (None in full sync mode).
+    """
+    with metrics.ACCOUNT_POLL_SECONDS.time(account=account['user_email']):
+        return _poll_account(account, secrets)
+
+def _poll_account(account, secrets):
+    logging.info(f"\nChecking account: {account['user_email']}")
+    service = gmail_clients.get_client(account, secrets, GMAIL_TRANSPORT)
+
+    history_id = None
+    if GMAIL_SYNC_MODE == 'history':
+        unread_messages, history_id = gmail_service.sync_unread_emails(service, account.get('history_id'))
+    else:
+        unread_messages = gmail_service.fetch_unread_emails(service)
+    
+    if USE_JOB_QUEUE:
+        return _poll_job_queue(account, service, unread_messages, history_id)
+
+    if not unread_messages:
+        logging.info("No new emails.")
+        return [], history_id
+
+    logging.info(f"Found {len(unread_messages)} new email(s).")
+    emails = processing_service.prepare_emails(service, unread_messages)
+    if len(emails) < len(unread_messages):
+        # Keep the old cursor so the messages that could not be fetched are retried
+        history_id = None
+    # A retried history range can list mail we already answered, so skip anything read
+    pending = [(service, account['user_email'], email) for email in emails if 'UNREAD' in email['labelIds']]
+    return pending, history_id
+
+def _poll_job_queue(account, service, unread_messages, history_id):
+    """
+    Queues the listed messages as jobs and fetches the jobs this replica can
+    claim, which also picks up retries and jobs left behind by a crashed replica.
+    """
+    user_email = account['user_email']
+    job_queue.enqueue(user_email, [message['id'] for message in unread_messages])
+    # Queued jobs are durable, so the cursor can move on straight away
+    save_history_id(account, history_id, [])
+
+    jobs = job_queue.claim(user_email, JOB_CLAIM_LIMIT)
+    if not jobs:
+        logging.info("No new emails.")
+        return [], None
+
+    logging.info(f"Claimed {len(jobs)} email job(s).")
+    job_ids = {job['message_id']: job['id'] for job in jobs}
+    emails = processing_service.prepare_emails(service, [{'id': job['message_id']} for job in jobs])
+    fetched = {email['id'] for email in emails}
+    for message_id, job_id in job_ids.items():
+        if message_id not in fetched:
+            job_queue.fail(job_id, "could not fetch message")
+
+    pending = []
+    for email in emails:
+        email['job_id'] = job_ids[email['id']]
+        if 'UNREAD' in email['labelIds']:
+            pending.append((service, user_email, email))
+        else:
+            # Read in the meantime, e.g. answered by a person
+            job_queue.complete([email['job_id']])
+    return pending, None
+
+def record_job_outcome(account, email, error):
+    """Completes an email's job once it is handled, or schedules a retry."""
+    if 'job_id' not in email:
+        return
+    if error is None:
+        job_queue.complete([email['job_id']])
+    else:
+        job_queue.fail(email['job_id'], error)
+
+def save_history_id(account, history_id, failed):
+    """
+    Stores the account's new sync cursor.
+
+    The cursor is not advanced while any of the account's emails failed, so
+    they are listed again and retried on the next cycle.
+    """
+    if history_id is None or history_id == account.get('history_id'):
+        return
+    if failed:
+        logging.warning(f"Keeping history id for {account['user_email']} so {len(failed)} failed email(s) are retried.")
+        return
+
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            "UPDATE connected_accounts SET history_id = %s WHERE user_email = %s",
+            (str(history_id), account['user_email'])
+        )
+    # The scheduler resubmits this same row, so its next poll starts from the new cursor
+    account['history_id'] = str(history_id)
 
 def main():
     """Main loop to fetch and process emails."""
     logging.basicConfig(
         level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
+        format='%(asctime)s - %(levelname)s - %(threadName)s - %(message)s',
         handlers=[
             logging.FileHandler("agent.log"), 
             logging.StreamHandler()         
@@ -28,90 +152,90 @@ def main():
         os.environ['GOOGLE_CLIENT_ID'] = secrets['client_id']
         os.environ['GOOGLE_CLIENT_SECRET'] = secrets['client_secret']
 
-    while True:
-        conn = None
-        try:
-            conn = get_db_connection()
-            cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            
-            cur.execute("SELECT * FROM connected_accounts;")
-            accounts = cur.fetchall()
-            
-            if not accounts:
-                logging.info("No connected accounts found. Please run app.py to connect an account.")
-                time.sleep(60)
-                continue
-
-            for account in accounts:
-                logging.info(f"\nChecking account: {account['user_email']}")
-                
+    if METRICS_PORT:
+        metrics.start_http_server(METRICS_PORT, ready_check=llm_service.is_ready)
+        logging.info(f"Serving metrics on port {METRICS_PORT} at /metrics and readiness at /ready.")
+
+    if llm_service.MODEL_WARMUP:
+        # Before the first poll, so a fresh replica takes no accounts until it is warm
+        logging.info("Warming up models...")
+        llm_service.warm_up()
+
+    scheduler = PollScheduler()
+    pipeline = EmailPipeline(
+        poll_account=lambda account: poll_account(account, secrets),
+        save_history_id=save_history_id,
+        fetchers=LISTENER_WORKERS,
+        handlers=PIPELINE_HANDLERS,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        email_done=record_job_outcome if USE_JOB_QUEUE else None,
+        account_done=lambda account, emails, error: scheduler.record(account['user_email'], emails, error)
+    )
+    pipeline.start()
+
+    stop = threading.Event()
+    def on_sigterm(signum, frame):
+        stop.set()
+        scheduler.wakeup.set()
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    # app.py reports connected and disconnected accounts, so they are picked up without waiting for the refresh
+    accounts_changed = threading.Event()
+    def on_account_change(user_email):
+        accounts_changed.set()
+        scheduler.wakeup.set()
+    threading.Thread(
+        target=gmail_clients.listen_for_changes, args=(on_account_change, stop),
+        name='account-changes', daemon=True
+    ).start()
+
+    next_refresh = 0
+    try:
+        while not stop.is_set():
+            scheduler.wakeup.clear()
+            if time.monotonic() >= next_refresh or accounts_changed.is_set():
+                accounts_changed.clear()
+                next_refresh = time.monotonic() + ACCOUNT_REFRESH_SECONDS
                 try:
-                    # Manually create credentials object from DB data
-                    decrypted_access_token = decrypt_token_from_str(account['access_token'])
-                    decrypted_refresh_token = decrypt_token_from_str(account['refresh_token'])
-                    creds_info = {
-                        'token': decrypted_access_token,
-                        'refresh_token': decrypted_refresh_token,
-                        'token_uri': 'https://oauth2.googleapis.com/token',
-                        'client_id': secrets['client_id'],
-                        'client_secret': secrets['client_secret'],
-                        'scopes': gmail_service.SCOPES
-                    }
-                    
-                    creds = Credentials.from_authorized_user_info(creds_info)
-                    
-                    # In run_listener.py, inside the main() -> while -> for -> try block
-
-                    if creds.expired and creds.refresh_token:
-                        from google.auth.transport.requests import Request
-                        logging.info("Refreshing token...")
-                        creds.refresh(Request())
-                        
-                        encrypted_new_access_token = encrypt_token_to_str(creds.token)
-                        # The refresh token might be None if one wasn't issued, so we keep the old one as a fallback.
-                        new_refresh_token = creds.refresh_token or decrypted_refresh_token
-                        encrypted_new_refresh_token = encrypt_token_to_str(new_refresh_token)
-
-                        cur.execute(
-                            """
-                            UPDATE connected_accounts 
-                            SET access_token = %s, refresh_token = %s, token_expiry = %s
-                            WHERE user_email = %s
-                            """,
-                            (encrypted_new_access_token, encrypted_new_refresh_token, creds.expiry, account['user_email'])
-                        )
-                        conn.commit()
-                        logging.info("Token refreshed and saved securely.")
-                        
-                        # Update the local decrypted variable so the rest of the script uses the new token
-                        decrypted_refresh_token = new_refresh_token
-
-
-                    service = gmail_service.build('gmail', 'v1', credentials=creds)
-                    unread_messages = gmail_service.fetch_unread_emails(service)
+                    with pooled_connection() as conn, conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                        cur.execute("SELECT * FROM connected_accounts;")
+                        accounts = cur.fetchall()
+
+                    if not accounts:
+                        logging.info("No connected accounts found. Please run app.py to connect an account.")
+                    elif USE_JOB_QUEUE:
+                        leased = job_queue.lease_accounts([account['user_email'] for account in accounts])
+                        logging.info(f"Holding leases on {len(leased)} of {len(accounts)} account(s).")
+                        accounts = [account for account in accounts if account['user_email'] in leased]
+                    scheduler.set_accounts([dict(account) for account in accounts])
                     
-                    if not unread_messages:
-                        logging.info("No new emails.")
-                    else:
-                        logging.info(f"Found {len(unread_messages)} new email(s).")
-                        for message_summary in unread_messages:
-                            # Pass a dictionary-like object for the account
-                            processing_service.process_email(service, dict(account), message_summary)
-
-                except Exception as e:
-                    logging.error(f"An error occurred while processing account {account['user_email']}:")
-                    logging.error(traceback.format_exc())
-
-            cur.close()
-            
-        except (Exception, psycopg2.DatabaseError) as error:
-            logging.error(f"Database error: {error}")
-        finally:
-            if conn is not None:
-                conn.close()
-
-        logging.info("Waiting for 60 seconds before next check...")
-        time.sleep(60)
+                except (Exception, psycopg2.DatabaseError) as error:
+                    logging.error(f"Database error: {error}")
+
+                # Separate from the account refresh, so a broken knowledge base edit cannot stop lease renewal
+                try:
+                    llm_service.refresh_knowledge_base()
+                except Exception as error:
+                    logging.error(f"Could not reload the knowledge base, keeping the current index: {error}")
+
+            # Each account comes up again only after its previous poll has finished,
+            # so a slow mailbox or a large backlog only delays itself
+            for account in scheduler.pop_due():
+                if not pipeline.submit_account(account):
+                    scheduler.record(account['user_email'], 0)
+
+            until_refresh = max(0, next_refresh - time.monotonic())
+            until_due = scheduler.seconds_until_next()
+            scheduler.wakeup.wait(until_refresh if until_due is None else min(until_due, until_refresh))
+    except KeyboardInterrupt:
+        pass
+
+    logging.info("Shutting down, finishing emails already in progress...")
+    pipeline.shutdown()
+    if USE_JOB_QUEUE:
+        # Lets other replicas take over our accounts without waiting for the leases to expire
+        job_queue.release_leases()
+    logging.info("Email listener stopped.")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,134 @@
+"""
+Per-account poll scheduling for the listener.
+
+Each account has its own next-due time in a heap, and its interval adapts to
+its traffic. A poll that finds mail halves the interval, down to
+POLL_MIN_INTERVAL. An empty poll grows it by POLL_IDLE_BACKOFF, and a failed
+poll doubles it, both up to POLL_MAX_INTERVAL. Due times are jittered, so
+accounts do not synchronize. POLL_BUDGET_PER_MINUTE caps polls across all
+accounts. An account is rescheduled only when its previous poll has finished,
+so a slow mailbox delays itself and no one else.
+"""
+import heapq
+import os
+import random
+import threading
+import time
+from metrics import Gauge
+
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "15"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "600"))
+# Interval of a newly seen account
+POLL_BASE_INTERVAL = float(os.getenv("POLL_BASE_INTERVAL", "60"))
+# Factor applied to the interval after a poll that found no mail
+POLL_IDLE_BACKOFF = float(os.getenv("POLL_IDLE_BACKOFF", "1.5"))
+# Each due time is moved by up to this fraction of the interval, either way
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
+# Polls started per minute across all accounts; 0 means no limit
+POLL_BUDGET_PER_MINUTE = float(os.getenv("POLL_BUDGET_PER_MINUTE", "0"))
+
+class PollScheduler:
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 base_interval=POLL_BASE_INTERVAL, budget_per_minute=POLL_BUDGET_PER_MINUTE):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.base_interval = base_interval
+        self.budget_per_minute = budget_per_minute
+        self._heap = [] # (due, sequence, user_email)
+        self._sequence = 0
+        self._scheduled = {} # user_email -> sequence of its live heap entry
+        self._accounts = {} # user_email -> account row
+        self._intervals = {}
+        self._busy = set()
+        self._budget = budget_per_minute
+        self._budget_updated = time.monotonic()
+        self._lock = threading.Lock()
+        # Set whenever the earliest due time may have moved closer
+        self.wakeup = threading.Event()
+        Gauge(
+            'account_poll_interval_seconds',
+            'Current polling interval per account.',
+            lambda: {(('account', email),): interval for email, interval in self.intervals().items()}
+        )
+
+    def _push(self, user_email, delay):
+        jitter = delay * POLL_JITTER * random.uniform(-1, 1)
+        self._sequence += 1
+        self._scheduled[user_email] = self._sequence
+        heapq.heappush(self._heap, (time.monotonic() + max(0, delay + jitter), self._sequence, user_email))
+
+    def set_accounts(self, accounts):
+        """
+        Updates the set of accounts to poll from fresh database rows. New
+        accounts are spread over the first POLL_MIN_INTERVAL seconds; removed
+        ones are dropped from the heap the next time they come up.
+        """
+        with self._lock:
+            fresh = {account['user_email']: account for account in accounts}
+            for user_email in list(self._accounts):
+                if user_email not in fresh:
+                    del self._accounts[user_email]
+                    self._intervals.pop(user_email, None)
+                    self._scheduled.pop(user_email, None)
+            for user_email, account in fresh.items():
+                if user_email not in self._accounts:
+                    self._intervals[user_email] = self.base_interval
+                    if user_email not in self._busy:
+                        self._push(user_email, random.uniform(0, self.min_interval))
+                self._accounts[user_email] = account
+        self.wakeup.set()
+
+    def _refill_budget(self, now):
+        if self.budget_per_minute:
+            self._budget = min(self.budget_per_minute, self._budget + (now - self._budget_updated) * self.budget_per_minute / 60)
+        self._budget_updated = now
+
+    def pop_due(self):
+        """Returns the accounts due for a poll now, within the budget, and marks them busy."""
+        due = []
+        with self._lock:
+            now = time.monotonic()
+            self._refill_budget(now)
+            while self._heap and self._heap[0][0] <= now:
+                if self.budget_per_minute and self._budget < 1:
+                    break
+                _, sequence, user_email = heapq.heappop(self._heap)
+                # Entries of removed or rescheduled accounts are dropped lazily
+                if user_email not in self._accounts or self._scheduled.get(user_email) != sequence:
+                    continue
+                del self._scheduled[user_email]
+                self._budget -= 1
+                self._busy.add(user_email)
+                due.append(self._accounts[user_email])
+        return due
+
+    def seconds_until_next(self):
+        with self._lock:
+            if not self._heap:
+                return None
+            wait = self._heap[0][0] - time.monotonic()
+            if self.budget_per_minute and self._budget < 1:
+                wait = max(wait, (1 - self._budget) * 60 / self.budget_per_minute)
+            return max(0, wait)
+
+    def record(self, user_email, emails, error=None):
+        """Reschedules an account after its poll, from how many emails it found or whether it failed."""
+        with self._lock:
+            self._busy.discard(user_email)
+            if user_email not in self._accounts:
+                return
+            interval = self._intervals.get(user_email, self.base_interval)
+            if error is not None:
+                interval *= 2
+            elif emails:
+                interval /= 2
+            else:
+                interval *= POLL_IDLE_BACKOFF
+            interval = min(self.max_interval, max(self.min_interval, interval))
+            self._intervals[user_email] = interval
+            self._push(user_email, interval)
+        self.wakeup.set()
+
+    def intervals(self):
+        with self._lock:
+            return dict(self._intervals)
@@ -0,0 +1,82 @@
+"""
+Tests for duplicate and thread suppression (dedup.py) as the listener runs it.
+
+Run with `python -m pytest`. Gmail, the models and the database are replaced
+with in-memory fakes, so no credentials or model downloads are needed.
+"""
+import pytest
+import dedup
+import gmail_service
+import llm_service
+import preclassifier
+import processing_service
+
+ACCOUNT = {'user_email': 'support@example.com'}
+
+def _email(message_id, body, internal_date, thread_id='thread-1', in_reply_to=None):
+    return {
+        'id': message_id,
+        'threadId': thread_id,
+        'internalDate': str(internal_date),
+        'labelIds': ['INBOX', 'UNREAD'],
+        'from': 'Customer <customer@example.com>',
+        'subject': 'Refund',
+        'body': body,
+        'body_type': 'text/plain',
+        'in_reply_to': in_reply_to
+    }
+
+@pytest.fixture
+def listener(monkeypatch):
+    """Runs process_email against fakes; returns the emails each handler received."""
+    monkeypatch.setattr(dedup, 'DEDUP_ENABLED', True)
+    monkeypatch.setattr(dedup, 'DEDUP_PERSIST', False)
+    monkeypatch.setattr(dedup, '_index', type(dedup._index)())
+    monkeypatch.setattr(preclassifier, 'PRECLASSIFIER', 'rules')
+    monkeypatch.setattr(preclassifier, 'PRECLASSIFIER_LOG', '')
+    monkeypatch.setattr(llm_service, 'embed_texts', lambda texts: [[1.0] * 8 for _ in texts])
+    monkeypatch.setattr(llm_service, 'categorize_emails', lambda bodies, batch_size=None: ['Refund'] * len(bodies))
+    monkeypatch.setattr(gmail_service, 'mark_as_read', lambda service, message_id: None)
+
+    inbox = {}
+    handled = {'Refund': [], 'Question': [], 'Other': []}
+    monkeypatch.setattr(gmail_service, 'get_email_details', lambda service, message_id: dict(inbox[message_id]))
+    monkeypatch.setattr(processing_service, 'handle_refund', lambda service, email: handled['Refund'].append(email))
+    monkeypatch.setattr(processing_service, 'handle_question', lambda service, email: handled['Question'].append(email))
+    monkeypatch.setattr(processing_service, 'handle_other', lambda service, email: handled['Other'].append(email))
+
+    def receive(email):
+        inbox[email['id']] = email
+        processing_service.process_email(None, ACCOUNT, {'id': email['id']})
+    return receive, handled
+
+def test_reply_with_order_id_in_same_thread_reaches_refund_handler(listener):
+    receive, handled = listener
+    receive(_email('msg-1', "Hello, I would like a refund, the lamp arrived broken.", 1000))
+    # Our reply asked for the order id; the customer answers in the same thread
+    receive(_email('msg-2', "Sure, the order id is ORD12345. Please process my refund.", 2000, in_reply_to='<reply-1@example.com>'))
+
+    assert [email['id'] for email in handled['Refund']] == ['msg-1', 'msg-2']
+    assert handled['Refund'][1]['in_reply_to'] == '<reply-1@example.com>'
+
+def test_repeated_message_in_later_poll_is_suppressed(listener):
+    receive, handled = listener
+    body = "Hello, I would like a refund for order ORD12345, the lamp arrived broken and I want my money back."
+    receive(_email('msg-1', body, 1000))
+    receive(_email('msg-2', body, 2000, thread_id='thread-2'))
+
+    assert [email['id'] for email in handled['Refund']] == ['msg-1']
+
+def test_same_batch_thread_collapses_into_newest_with_all_text():
+    first = _email('msg-1', "I want a refund.", 1000)
+    second = _email('msg-2', "The order id is ORD12345.", 2000)
+    for email in (first, second):
+        email['clean_body'] = email['body']
+
+    dropped = dedup._collapse_threads([('support@example.com', first), ('support@example.com', second)])
+
+    assert dropped == {0: 'thread'}
+    assert first['collapsed_into'] == 'msg-2'
+    assert second['collapsed'] == [first]
+    assert "I want a refund." in second['body'] and "ORD12345" in second['body']
+    assert "I want a refund." in second['clean_body']
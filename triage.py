@@ -0,0 +1,136 @@
+"""
+Queries behind the triage pages in app.py.
+
+Pages use keyset pagination: newest first, continuing from the (timestamp, id)
+of the last row shown. The cost of a page does not grow with its depth. Totals
+are cached for TRIAGE_COUNT_TTL_SECONDS per filter combination, since counting
+millions of rows on every page view is what gets slow. Full-text search over
+subject and body uses the GIN index created when TRIAGE_FULL_TEXT=1.
+"""
+import os
+import threading
+import time
+from datetime import timedelta
+from database import pooled_connection
+
+TRIAGE_PAGE_SIZE = int(os.getenv("TRIAGE_PAGE_SIZE", "50"))
+TRIAGE_COUNT_TTL_SECONDS = float(os.getenv("TRIAGE_COUNT_TTL_SECONDS", "30"))
+# Creates (in setup_database) and uses the full-text index on unhandled_emails
+TRIAGE_FULL_TEXT = os.getenv("TRIAGE_FULL_TEXT", "0") == "1"
+
+STATUSES = ('pending', 'in_progress', 'resolved')
+CATEGORIES = ('Question', 'Refund', 'Other')
+# Must match the expression of idx_unhandled_emails_search for the index to be used
+SEARCH_VECTOR = "to_tsvector('english', coalesce(subject, '') || ' ' || coalesce(body, ''))"
+
+_counts = {} # (table, where, params) -> (count, expires_at)
+_counts_lock = threading.Lock()
+
+def _unhandled_filters(filters):
+    clauses, params = [], []
+    if filters.get('status'):
+        clauses.append("status = %s")
+        params.append(filters['status'])
+    if filters.get('category'):
+        clauses.append("category = %s")
+        params.append(filters['category'])
+    if filters.get('min_importance'):
+        clauses.append("importance >= %s")
+        params.append(int(filters['min_importance']))
+    if filters.get('since'):
+        clauses.append("received_at >= %s")
+        params.append(filters['since'])
+    if filters.get('until'):
+        # Inclusive of the whole end day
+        clauses.append("received_at < %s")
+        params.append(filters['until'] + timedelta(days=1))
+    if filters.get('q') and TRIAGE_FULL_TEXT:
+        clauses.append(f"{SEARCH_VECTOR} @@ websearch_to_tsquery('english', %s)")
+        params.append(filters['q'])
+    return clauses, params
+
+def _refund_filters(filters):
+    clauses, params = [], []
+    if filters.get('customer'):
+        clauses.append("customer_email = %s")
+        params.append(filters['customer'])
+    if filters.get('since'):
+        clauses.append("logged_at >= %s")
+        params.append(filters['since'])
+    if filters.get('until'):
+        clauses.append("logged_at < %s")
+        params.append(filters['until'] + timedelta(days=1))
+    return clauses, params
+
+def _where(clauses):
+    return f"WHERE {' AND '.join(clauses)}" if clauses else ""
+
+def _cached_count(table, clauses, params):
+    key = (table, tuple(clauses), tuple(str(param) for param in params))
+    now = time.monotonic()
+    with _counts_lock:
+        cached = _counts.get(key)
+        if cached and cached[1] > now:
+            return cached[0]
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT COUNT(*) FROM {table} {_where(clauses)}", params)
+        count = cur.fetchone()[0]
+    with _counts_lock:
+        # Expired entries are swept whenever a count is stored, so the cache stays small
+        for stale in [k for k, (_, expires_at) in _counts.items() if expires_at <= now]:
+            del _counts[stale]
+        _counts[key] = (count, now + TRIAGE_COUNT_TTL_SECONDS)
+    return count
+
+def _page(table, columns, time_column, clauses, params, after, limit):
+    clauses, params = list(clauses), list(params)
+    if after:
+        # Row comparison matches the (time, id) index order, so Postgres seeks straight to the page
+        clauses.append(f"({time_column}, id) < (%s, %s)")
+        params.extend(after)
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT {', '.join(columns)} FROM {table} {_where(clauses)}
+            ORDER BY {time_column} DESC, id DESC
+            LIMIT %s
+            """,
+            params + [limit + 1]
+        )
+        names = [column[0] for column in cur.description]
+        rows = [dict(zip(names, row)) for row in cur.fetchall()]
+    next_after = (rows[limit - 1][time_column], rows[limit - 1]['id']) if len(rows) > limit else None
+    return rows[:limit], next_after
+
+def unhandled_page(filters, after=None, limit=TRIAGE_PAGE_SIZE):
+    """
+    Returns (rows, total, next_after) for unhandled emails matching `filters`
+    (status, category, min_importance, since, until, q), newest first.
+    """
+    clauses, params = _unhandled_filters(filters)
+    rows, next_after = _page(
+        'unhandled_emails',
+        ('id', 'received_at', 'received_from', 'subject', 'category', 'importance', 'status', 'left(body, 300) AS preview'),
+        'received_at', clauses, params, after, limit
+    )
+    return rows, _cached_count('unhandled_emails', clauses, params), next_after
+
+def refund_requests_page(filters, after=None, limit=TRIAGE_PAGE_SIZE):
+    """Returns (rows, total, next_after) for logged refund requests with unknown order ids, newest first."""
+    clauses, params = _refund_filters(filters)
+    rows, next_after = _page(
+        'not_found_refund_requests',
+        ('id', 'logged_at', 'customer_email', 'invalid_order_id_attempted', 'left(full_email_body, 300) AS preview'),
+        'logged_at', clauses, params, after, limit
+    )
+    return rows, _cached_count('not_found_refund_requests', clauses, params), next_after
+
+def set_status(email_id, status):
+    """Moves an unhandled email to another triage status."""
+    if status not in STATUSES:
+        raise ValueError(f"Unknown status: {status}")
+    with pooled_connection() as conn, conn.cursor() as cur:
+        cur.execute("UPDATE unhandled_emails SET status = %s WHERE id = %s", (status, email_id))
+    # Counts per status are now off, so drop them rather than show stale totals
+    with _counts_lock:
+        _counts.clear()
@@ -0,0 +1,107 @@
+"""
+Write-behind buffer for the rows the handlers insert.
+
+Handlers add rows and get a Future back instead of opening a transaction per
+email. A background thread writes everything pending with one
+`execute_values` INSERT per table, all in a single transaction. It does so
+once WRITE_BUFFER_SIZE rows are waiting or the oldest has waited
+WRITE_BUFFER_MAX_DELAY_MS. A Future resolves only once its row is committed, so
+callers wait on it before they mark the message as read.
+"""
+import logging
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from psycopg2.extras import execute_values
+import database
+from metrics import STAGE_SECONDS
+
+WRITE_BUFFER_SIZE = int(os.getenv("WRITE_BUFFER_SIZE", "500"))
+WRITE_BUFFER_MAX_DELAY_MS = float(os.getenv("WRITE_BUFFER_MAX_DELAY_MS", "200"))
+
+def insert_rows(cur, table, columns, rows):
+    """Inserts many rows with one statement per page."""
+    execute_values(cur, f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s", rows, page_size=1000)
+
+class WriteBuffer:
+    def __init__(self, max_rows=WRITE_BUFFER_SIZE, max_delay=WRITE_BUFFER_MAX_DELAY_MS / 1000):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        # Both looked up at flush time so they can be swapped (e.g. by the benchmark)
+        self.connection_factory = None
+        self.insert_rows = insert_rows
+        self._pending = {} # (table, columns) -> [(row, future)]
+        self._count = 0
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def add(self, table, columns, row):
+        """Queues one row for `table` and returns a Future that resolves once it is committed."""
+        future = Future()
+        with self._condition:
+            self._pending.setdefault((table, tuple(columns)), []).append((row, future))
+            self._count += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name='write-buffer', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return future
+
+    def _take(self):
+        with self._condition:
+            pending, self._pending = self._pending, {}
+            self._count = 0
+            self._oldest = None
+        return pending
+
+    def flush(self):
+        """Writes everything pending now, in the calling thread."""
+        # Serialized, so a caller that finds the buffer empty also waits for an in-progress flush
+        with self._flush_lock:
+            pending = self._take()
+            if not pending:
+                return
+            futures = [future for entries in pending.values() for _, future in entries]
+            try:
+                connection = self.connection_factory or database.pooled_connection
+                with STAGE_SECONDS.time(stage='db_flush'), connection() as conn, conn.cursor() as cur:
+                    for (table, columns), entries in pending.items():
+                        self.insert_rows(cur, table, columns, [row for row, _ in entries])
+            except Exception as error:
+                logging.error(f"Could not write {len(futures)} buffered row(s):")
+                logging.error(traceback.format_exc())
+                for future in futures:
+                    future.set_exception(error)
+                return
+            for future in futures:
+                future.set_result(None)
+
+    def _flush_loop(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._count >= self.max_rows:
+                        break
+                    if self._oldest is not None:
+                        remaining = self._oldest + self.max_delay - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+            self.flush()
+
+def wait_for(futures):
+    """Waits for the given rows to be committed; returns the first error, or None."""
+    for future in futures:
+        try:
+            future.result()
+        except Exception as error:
+            return error
+    return None